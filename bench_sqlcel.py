@@ -0,0 +1,195 @@
+'''
+code file: bench_sqlcel.py
+comments:
+    Benchmarks for sqlcel.py
+    Generates synthetic CSV, XLSX and SQLite inputs at several sizes
+    and widths, runs code files through sqlcel.py in console mode and
+    records the time of each step (create_df, to_sql, query, display
+    and every Output writer) in a json file.
+    The scaling cases run a GROUP BY query on a csv of --scale-rows rows
+    (at least the 500,000 sqlcel splits) with --parallel N for every
+    worker count and report the query speedup.
+use:
+    python3 bench_sqlcel.py [--rows 1000,10000,100000] [--cols 5,20]
+                            [--repeat 3] [--out results.json]
+                            [--workers 1,2,4,8] [--scale-rows 500000]
+                            [--compare earlier_results.json]
+'''
+import os, sys, json, time
+import platform
+import statistics
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+
+SQLCEL = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sqlcel.py")
+XLSX_MAX_ROWS = 100000  # bigger workbooks take too long to generate
+SLOWER = 1.10  # --compare flags steps more than 10% slower
+PARALLEL_ROWS = 500000  # sqlcel.py aggregates smaller tables on one connection
+GROUP_SQL = "select s2, count(*), sum(f1), avg(n0), min(n0), max(f1) from t group by s2"
+
+
+def option(name, default):
+    ''' value following a command line option or the default '''
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def make_frame(rows, cols):
+    ''' synthetic table with a repeating mix of int, float, text and date columns '''
+    rng = np.random.RandomState(rows + cols)  # same data every run
+    data = {}
+    for c in range(cols):
+        kind = c % 4
+        if kind == 0:
+            data["n%d" % c] = rng.randint(0, 1000, rows)
+        elif kind == 1:
+            data["f%d" % c] = rng.random_sample(rows) * 1000
+        elif kind == 2:
+            data["s%d" % c] = rng.choice(["north", "south", "east", "west", "central"], rows)
+        else:
+            data["d%d" % c] = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.randint(0, 2000, rows), unit="D")
+    return pd.DataFrame(data)
+
+
+def make_inputs(folder, rows, cols):
+    ''' write the synthetic table as csv, xlsx and sqlite - returns {kind: (path, sheet)} '''
+    df = make_frame(rows, cols)
+    stem = os.path.join(folder, "t_%d_%d" % (rows, cols))
+    inputs = {}
+    df.to_csv(stem + ".csv", index=False)
+    inputs['csv'] = (stem + ".csv", "0")
+    if rows <= XLSX_MAX_ROWS:
+        df.to_excel(stem + ".xlsx", index=False)
+        inputs['xlsx'] = (stem + ".xlsx", "0")
+    df.to_sql("t", "sqlite:///" + stem + ".sqlite", index=False, if_exists='replace')
+    inputs['sqlite'] = (stem + ".sqlite", "t")
+    return inputs
+
+
+def code_file(folder, name, infile, sheet, outpath, sql="select * from t where n0 >= 0"):
+    ''' write a sqlcel code file for one benchmark case '''
+    text = "Input\n{}\n{}\nt\n\n".format(infile, sheet)
+    if outpath is not None:
+        text += "Output\n{}\n\n".format(outpath)
+    text += "sql\n" + sql + "\n"
+    path = os.path.join(folder, name + ".txt")
+    with open(path, "w") as fh:
+        fh.write(text)
+    return path
+
+
+def run_case(folder, codefile, repeat, extra=()):
+    ''' run sqlcel.py on a code file repeat times - returns median step and wall times '''
+    timings = os.path.join(folder, "timings.json")
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, SQLCEL, codefile, "--timings", timings] + list(extra),
+                       stdout=subprocess.DEVNULL, check=True)
+        wall = time.perf_counter() - t0
+        with open(timings) as fh:
+            steps = json.load(fh)
+        steps['wall'] = wall
+        runs.append(steps)
+    return {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+
+
+def versions():
+    ''' library versions that change sqlcel speed '''
+    found = {'python': platform.python_version(), 'platform': platform.platform()}
+    for name in ('pandas', 'numpy', 'sqlalchemy', 'openpyxl', 'xlsxwriter', 'pyarrow'):
+        try:
+            found[name] = __import__(name).__version__
+        except ImportError:
+            found[name] = None
+    return found
+
+
+def compare(results, oldfile):
+    ''' print step time ratios against an earlier results file '''
+    with open(oldfile) as fh:
+        old = {c['case']: c['steps'] for c in json.load(fh)['cases']}
+    print("\ncompared with", oldfile)
+    for c in results['cases']:
+        before = old.get(c['case'])
+        if before is None:
+            continue
+        for step, secs in c['steps'].items():
+            if before.get(step):
+                ratio = secs / before[step]
+                flag = "  <-- slower" if ratio > SLOWER else ""
+                print("{:32} {:14} {:6.2f}x{}".format(c['case'], step, ratio, flag))
+
+
+def main():
+    sizes = [int(n) for n in option("--rows", "1000,10000,100000").split(",")]
+    widths = [int(n) for n in option("--cols", "5,20").split(",")]
+    repeat = int(option("--repeat", "3"))
+    outfile = option("--out", time.strftime("bench_%Y%m%d_%H%M%S.json"))
+    workers = [int(n) for n in option("--workers", "1,2,4").split(",")]
+    scale_rows = int(option("--scale-rows", str(PARALLEL_ROWS)))
+
+    results = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+               'versions': versions(),
+               'cpus': os.cpu_count(),
+               'repeat': repeat,
+               'cases': [],
+               'scaling': []}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in sizes:
+            for cols in widths:
+                inputs = make_inputs(folder, rows, cols)
+                cases = []
+                # ingest path of every input type, no output file
+                for kind, (infile, sheet) in inputs.items():
+                    cases.append(("in_%s" % kind, infile, sheet, None))
+                # every Output writer, fed from the csv input
+                for kind in ('csv', 'xlsx', 'sqlite'):
+                    if kind == 'xlsx' and rows > XLSX_MAX_ROWS:
+                        continue
+                    infile, sheet = inputs['csv']
+                    cases.append(("out_%s" % kind, infile, sheet,
+                                  os.path.join(folder, "out." + kind)))
+
+                for name, infile, sheet, outpath in cases:
+                    case = "%s_%dx%d" % (name, rows, cols)
+                    codefile = code_file(folder, case, infile, sheet, outpath)
+                    steps = run_case(folder, codefile, repeat)
+                    results['cases'].append({'case': case, 'rows': rows, 'cols': cols,
+                                             'steps': steps})
+                    print("{:32} ".format(case) +
+                          " ".join("{}={:.3f}".format(k, v) for k, v in steps.items()))
+
+        # parallel GROUP BY on a table of its own - sqlcel splits PARALLEL_ROWS rows and up
+        # --parallel puts every worker count on the scratch database file, 1 included
+        rows = scale_rows
+        if rows < PARALLEL_ROWS:
+            print("scaling skipped: --scale-rows {} is below the {} rows sqlcel splits".format(
+                rows, PARALLEL_ROWS))
+        else:
+            infile = os.path.join(folder, "scale_%d.csv" % rows)
+            make_frame(rows, 5).to_csv(infile, index=False)
+            codefile = code_file(folder, "group_%d" % rows, infile, "0", None, GROUP_SQL)
+            base = None
+            for n in workers:
+                query = run_case(folder, codefile, repeat, ["--parallel", str(n)])['query']
+                base = base or query
+                results['scaling'].append({'rows': rows, 'workers': n, 'query': query,
+                                           'speedup': base / query})
+                print("{:32} workers={} query={:.3f} speedup={:.2f}x".format(
+                    "group_%d" % rows, n, query, base / query))
+
+    with open(outfile, "w") as fh:
+        json.dump(results, fh, indent=1)
+    print("results written to", outfile)
+
+    if "--compare" in sys.argv:
+        compare(results, option("--compare", None))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,19 +16,33 @@ from tkinter.ttk import *  # defaults all widgets as ttk
 from tkinter.font import Font
 from tkinter import messagebox
 from tkinter import filedialog
-import os, io, sys
+import os, io, re, sys, time, json
+import csv
+import glob
+import gzip, bz2, lzma, zipfile
+import queue
 import logging
 import platform
 import threading
 import subprocess
+import sqlite3
+import atexit
+import tempfile
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 from ttkthemes import ThemedTk  # ttkthemes applied to all widgets
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-from PIL import Image, ImageTk
-import pandas as pd
-import matplotlib.pyplot as plt
 import iniproc  # ini file reader module (local)
 
+START_TIME = time.perf_counter()  # for the time to first paint
+
+# pandas, sqlalchemy and matplotlib are slow to import - see load_modules()
+pd = None
+np = None
+create_engine = None
+MODULES_LOCK = threading.Lock()
+
 
 if platform.system() == "Windows":
     PYTHON = "pythonw.exe"
@@ -39,16 +53,48 @@ else:
 p = os.path.realpath(__file__)
 os.chdir(os.path.dirname(p))
 
-# sql can set its own limits - so open it up
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', None)
-pd.set_option('display.max_colwidth', None)
-#pd.options.display.float_format = '{:,.2f}'.format
+
+def load_modules():
+    '''
+    Import pandas and sqlalchemy the first time they are needed so the
+    window shows up without waiting for them. The GUI also warms them in
+    a background thread right after the first paint (warm_modules).
+    '''
+    global pd, np, create_engine, EXCEL_EPOCH, XLSX_ENGINE
+    with MODULES_LOCK:
+        if pd is not None:
+            return
+        from sqlalchemy import create_engine as sa_create_engine
+        import numpy
+        import pandas
+
+        # sql can set its own limits - so open it up
+        pandas.set_option('display.max_rows', None)
+        pandas.set_option('display.max_columns', None)
+        pandas.set_option('display.width', None)
+        pandas.set_option('display.max_colwidth', None)
+        #pandas.options.display.float_format = '{:,.2f}'.format
+
+        try:
+            import python_calamine  # fast Rust workbook reader for sheet sets
+            XLSX_ENGINE = 'calamine'
+        except ImportError:
+            XLSX_ENGINE = None
+        create_engine = sa_create_engine
+        EXCEL_EPOCH = pandas.Timestamp("1899-12-30")
+        np = numpy
+        pd = pandas
+
+
+def warm_modules():
+    ''' background thread - import the heavy modules while the user looks at the window '''
+    load_modules()
+    import matplotlib.figure  # most of the plot import time, no GUI involved
+
 
 # get sqlcel.ini values
 fg_, bg_, font_, size_, cursor_, tab_, ofg_, obg_, ofont_, \
-remark_, section_, literal_, number_, wtheme_ = iniproc.read("sqlcel.ini",
+remark_, section_, literal_, number_, wtheme_, rows_, budget_, cliprows_, workers_ = iniproc.read("sqlcel.ini",
                                                 'Foreg',
                                                 'Backg',
                                                 'Font',
@@ -62,14 +108,58 @@ remark_, section_, literal_, number_, wtheme_ = iniproc.read("sqlcel.ini",
                                                 'Section',
                                                 'Literal',
                                                 'Number',
-                                                'WinTheme'
+                                                'WinTheme',
+                                                'Rows',
+                                                'Budget',
+                                                'ClipRows',
+                                                'Workers'
                                                 )
 
-tbl_info = ""
+PROFILE = None  # column profile of the displayed result: {'table': rows or None while busy}
+PROFILE_ROWS = 100000  # bigger results are profiled from a sample and HyperLogLog
 SQL_file = ""
 RUN_CONSOLE = False
 DF = 0  # copy of displayed df. Used by launch_plotter
 t = None
+LAST_RUN = None  # GUI: engine, sql and params of the displayed result (plot aggregation)
+PLOT_POINTS = 2000  # most points drawn for a line, scatter switches to hexbin at 5x
+PLOT_BINS = 80  # hexbin grid size
+PLOT_BARS = 200  # more rows than this are summed per x by the sql engine
+XLSX_ROWS = 1048575  # data rows per sheet - with the header Excel's 1,048,576 row limit
+XLSX_CHUNK = 10000  # rows converted at a time by write_xlsx
+SQLITE_CHUNK = 50000  # rows per executemany batch of write_sqlite
+SAVE_CHUNK = 50000  # rows per step of the Save As writers (progress bar)
+INPUT_WORKERS = min(32, os.cpu_count() or 4)  # threads reading the files of a glob Input
+DATA_FILES = ('.csv', '.xlsx', '.xls', '.sqlite', '.sqlite3', '.db',
+              '.parquet', '.jsonl', '.ndjson')  # read from a directory Input
+COMPRESSED = ('.gz', '.bz2', '.xz', '.zst', '.zip')  # Inputs decompressed while they are read
+JSON_LINES = ('.jsonl', '.ndjson')
+READ_AHEAD = 1024 * 1024  # bytes per block a decompress thread hands to the parser
+XLSX_ENGINE = None  # 'calamine' when python-calamine is installed - set by load_modules
+ARROW_BATCH = 65536  # cursor rows per Arrow record batch (query_frame)
+ARROW_ERRORS = (ImportError, TypeError, ValueError, OverflowError)  # ArrowInvalid is a ValueError
+EXCEL_EPOCH = None  # day 0 of Excel dates - set by load_modules
+MORE = None  # pending rows of an interactive run: {'rows': fetch function, 'close': cursor close or None}
+WATCHING = False  # watch mode is re-running the code file on changes
+WATCH_STATE = None  # GUI watch mode: resident engine and poll stamps
+WATCH_POLL = 1.0  # seconds between watch mode polls
+TIMES = threading.local()  # step timings (seconds) of the last exec_sql in this thread
+LAST_MSG = threading.local()  # last console route_msg in this thread
+BUDGET = int(budget_) * 1024 * 1024  # Budget in sqlcel.ini (MB) - 0 keeps every run in memory
+INPUT_FACTOR = {'.csv': 4, '.xlsx': 10, '.xls': 6}  # rough RAM per byte of input file (DataFrame + SQLite)
+SPILL_ROWS = 100000  # csv rows read at a time into the scratch database
+SCRATCH_CACHE = 256  # MB of page cache per scratch database connection
+SCRATCH_MMAP = 1024  # MB of the scratch database file memory mapped
+SCRATCH = {}  # scratch database engines still in use: {engine: path}
+WORKERS = int(workers_)  # Workers in sqlcel.ini or --parallel N - over 1 splits big GROUP BY queries
+PARALLEL_ROWS = 500000  # smaller tables are aggregated by one connection
+PARALLEL_SET = False  # --parallel given: scratch database file for any N, so N=1 compares like for like
+PARALLEL_AGGS = ('sum', 'count', 'min', 'max', 'avg', 'total')  # aggregates merged from partitions
+SERVE_STATE = threading.local()  # serve mode: warm engine per worker thread
+SERVE_CHUNK = 50000  # rows per streamed chunk in serve mode
+SERVE_FORMATS = {'csv': 'text/csv',
+                 'json': 'application/json',
+                 'arrow': 'application/vnd.apache.arrow.stream'}
 
 def edit_check():
     ''' Prompting to leave unsaved edits
@@ -142,6 +232,8 @@ def add_df_src(event=None):
     '''
     f = filedialog.askopenfilename(filetypes=(("Excel", "*.xls*"),
                                               ("CSV text", "*.csv"),
+                                              ("Compressed", "*.gz *.bz2 *.xz *.zst *.zip"),
+                                              ("Parquet / JSON lines", "*.parquet *.jsonl *.ndjson"),
                                               ("Sqlite", "*.*")))
     if f:
         new_code = "Input\n" + f + "\n0\ntbl\n\n"
@@ -184,9 +276,9 @@ def df_info_view():
     '''
     Actions for the "table info" button.
     1. Display a sample of the (dataframe) if a file path was selected .. or ..
-    2. Popup the df.info for the last SQL execution result
+    2. Popup the column profile of the last SQL execution result
     '''
-    global tbl_info
+    load_modules()
     txt.focus()
     try:
         item = "0"  # default sheet 0
@@ -219,7 +311,7 @@ def df_info_view():
                 # df = pd.read_sql_table('snippet', conn, parse_dates=True)
                 # conn.close()
 
-            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_').str.replace('(', '').str.replace(')', '')
+            clean_columns(df)
             data_top = df.head()
             # display
             txt.insert(END, data_top)
@@ -232,22 +324,18 @@ def df_info_view():
     except:
         pass
 
-    if tbl_info == "":  # may be empty if no SQL was run yet
+    if PROFILE is None:  # may be empty if no SQL was run yet
         return
 
-    tl = Toplevel()
-    tl.wm_title("Info")
-    L = Label(tl)
-    L.pack(side="top", fill="both", expand=True, padx=5, pady=5)
-    L['text'] = tbl_info
+    show_profile()
 
 
 def clear_output():
     ''' deletes everyting in the output Text widget and clears output information '''
-    global tbl_info
+    global PROFILE
     var_bottom.set("")
     txt.delete("1.0", END)
-    tbl_info = ""
+    PROFILE = None
 
 
 def alter_output_size(s):
@@ -260,8 +348,9 @@ def alter_output_size(s):
 def launch_plotter():
     ''' Popup to set and display xy plot using current table items '''
     global DF
+    load_modules()
     npcols = DF.columns.values
-    ax = plt.gca()
+    layers = []  # every Set adds one layer to the plot
     colistx = npcols.tolist()
     colisty = npcols.tolist()
     colistx.insert(0, "X COLUMN")
@@ -277,12 +366,12 @@ def launch_plotter():
         if k == 'TYPE OF PLOT' or x == 'X COLUMN' or y == 'Y COLUMN' or cx == 'COLOR X':
             route_msg("Plot Setting Error", "One or more unset parameters", "error")
             return
-        DF.plot(kind=k, x=x, y=y, color=cx, ax=ax)
+        layers.append((k, x, y, cx))
         btn_plot['state'] = 'normal'
 
 
     def exec_plot():
-        plt.show()
+        show_plot(layers)
         pt.destroy()
 
 
@@ -324,66 +413,673 @@ def launch_plotter():
     btn_plot.pack(pady=3, padx=3, fill=X)
 
 
+def show_plot(layers):
+    '''
+    Draw the Set plot layers in a window with the matplotlib canvas embedded.
+    Big results are drawn with fewer points (see plot_line, plot_scatter and
+    plot_bar) and redrawn from the full data when the user zooms or pans.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+    pw = Toplevel()
+    # bars alone over a result with rows still pending: the sql engine sums them
+    clipped = MORE is not None and LAST_RUN is not None and all(k == 'bar' for k, x, y, cx in layers)
+    if clipped:
+        df = DF
+        pw.wm_title("Plot")
+    else:
+        df = plot_frame()
+        pw.wm_title("Plot - {:,} rows".format(len(df)))
+    fig = Figure(figsize=(8, 5))
+    ax = fig.add_subplot()
+    canvas = FigureCanvasTkAgg(fig, master=pw)
+    NavigationToolbar2Tk(canvas, pw)  # zoom / pan
+    canvas.get_tk_widget().pack(fill=BOTH, expand=True)
+
+    redraws = []  # zoom / pan handlers of the downsampled layers
+    for k, x, y, cx in layers:
+        if k == 'line':
+            redraws.append(plot_line(ax, df, x, y, cx))
+        elif k == 'scatter':
+            redraws.append(plot_scatter(ax, df, x, y, cx))
+        else:
+            plot_bar(ax, df, x, y, cx, clipped)
+    ax.set_xlabel(layers[-1][1])
+    if len(layers) > 1:
+        ax.legend()
+    # from here on only the user moves the view - redraws must not rescale it
+    ax.autoscale_view()
+    ax.set_autoscale_on(False)
+    for redraw in redraws:
+        if redraw is not None:
+            ax.callbacks.connect('xlim_changed', redraw)
+            ax.callbacks.connect('ylim_changed', redraw)
+    canvas.draw()
+
+
+def plot_frame():
+    '''
+    The complete result to plot. When the display holds only the
+    first rows (More / Full pending) the rest is fetched - the query
+    does not run again.
+    '''
+    return full_result()
+
+
+def plot_xy(df, x, y):
+    '''
+    x and y columns as float arrays without the missing values.
+    Dates become matplotlib date numbers - returns xs, ys, is_date
+    '''
+    import matplotlib.dates as mdates
+    xcol = df[x]
+    is_date = pd.api.types.is_datetime64_any_dtype(xcol)
+    if is_date:
+        xs = mdates.date2num(xcol)
+    elif pd.api.types.is_numeric_dtype(xcol):
+        xs = xcol.to_numpy(dtype=float, na_value=np.nan)
+    else:
+        xs = np.arange(len(xcol), dtype=float)  # text: plot against the row number
+    ys = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    ok = ~(np.isnan(xs) | np.isnan(ys))
+    return xs[ok], ys[ok], is_date
+
+
+def lttb(xs, ys, n):
+    '''
+    Largest-Triangle-Three-Buckets: pick n points that keep the visual shape of a line
+    xs must be sorted - returns the indices of the points to keep
+    '''
+    size = len(xs)
+    if n >= size or n < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)  # n-2 buckets between first and last
+    keep = np.empty(n, dtype=int)
+    keep[0] = 0
+    keep[-1] = size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < n - 1 else size
+        avx = xs[hi:nhi].mean()  # average point of the next bucket
+        avy = ys[hi:nhi].mean()
+        area = np.abs((xs[a] - avx) * (ys[lo:hi] - ys[a]) - (xs[a] - xs[lo:hi]) * (avy - ys[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+
+def plot_line(ax, df, x, y, cx):
+    '''
+    line plot downsampled to PLOT_POINTS with LTTB
+    returns the zoom / pan handler that resamples the visible part (None if not needed)
+    '''
+    xs, ys, is_date = plot_xy(df, x, y)
+    order = np.argsort(xs, kind='stable')
+    xs, ys = xs[order], ys[order]
+    keep = lttb(xs, ys, PLOT_POINTS)
+    line, = ax.plot(xs[keep], ys[keep], color=cx, label=y)
+    if is_date:
+        ax.xaxis_date()
+    if len(xs) <= PLOT_POINTS:
+        return None
+
+    def resample(axes):
+        lo, hi = axes.get_xlim()
+        start = max(np.searchsorted(xs, lo) - 1, 0)  # one point past each edge
+        end = min(np.searchsorted(xs, hi) + 1, len(xs))
+        keep = start + lttb(xs[start:end], ys[start:end], PLOT_POINTS)
+        line.set_data(xs[keep], ys[keep])
+        axes.figure.canvas.draw_idle()
+
+    return resample
+
+
+def plot_scatter(ax, df, x, y, cx):
+    '''
+    scatter plot - a hexbin density plot of the visible points when there are too many
+    returns the zoom / pan handler that bins the visible part again (None if not needed)
+    '''
+    xs, ys, is_date = plot_xy(df, x, y)
+    if is_date:
+        ax.xaxis_date()
+    if len(xs) <= PLOT_POINTS * 5:
+        ax.scatter(xs, ys, color=cx, s=6, label=y)
+        return None
+
+    layer = [ax.hexbin(xs, ys, gridsize=PLOT_BINS, mincnt=1, cmap='viridis', label=y)]
+
+    def rebin(axes):
+        (xlo, xhi), (ylo, yhi) = axes.get_xlim(), axes.get_ylim()
+        seen = (xs >= xlo) & (xs <= xhi) & (ys >= ylo) & (ys <= yhi)
+        layer[0].remove()
+        layer[0] = axes.hexbin(xs[seen], ys[seen], gridsize=PLOT_BINS, mincnt=1,
+                               cmap='viridis', extent=(xlo, xhi, ylo, yhi))
+        axes.figure.canvas.draw_idle()
+
+    return rebin
+
+
+def plot_bar(ax, df, x, y, cx, clipped=False):
+    '''
+    bar plot - when there are more rows than PLOT_BARS the sum of y per x
+    is done here, or by the sql engine (GROUP BY around the users query)
+    when df is clipped to the first rows of the result
+    '''
+    if clipped:
+        sql = "SELECT {0}, SUM({1}) AS {1} FROM ({2}) GROUP BY {0} ORDER BY {0}".format(
+            '"' + x + '"', '"' + y + '"', LAST_RUN['sql'].strip())
+        df = pd.read_sql_query(sql, con=LAST_RUN['engine'], params=LAST_RUN['params'])
+    elif len(df) > PLOT_BARS:
+        df = df.groupby(x, as_index=False)[y].sum()
+    ax.bar(df[x].astype(str), df[y], color=cx, label=y)
+    if len(df) > 30:
+        ax.tick_params(axis='x', labelrotation=90, labelsize=6)
+
+
+#
+# Column profile for the Table Info popup
+#
+
+def start_profile(df):
+    ''' profile the new result in a background thread - the display never waits for it '''
+    global PROFILE
+    PROFILE = {'table': None}
+    threading.Thread(target=profile_worker, args=(df, PROFILE), daemon=True).start()
+
+
+def profile_worker(df, slot):
+    ''' background thread - fills in the slot given by start_profile '''
+    try:
+        slot['table'] = profile_frame(df)
+    except Exception as e:
+        slot['table'] = e
+
+
+def profile_frame(df):
+    '''
+    One row per column: type, nulls, distinct values, min, max, top values
+    and memory. Nulls, min and max of numbers and dates are computed on all
+    rows. Beyond PROFILE_ROWS rows, distinct is a HyperLogLog estimate, and
+    text min/max, top values and text memory come from a sample (marked ~).
+    '''
+    n = len(df)
+    sample = df
+    if n > PROFILE_ROWS:
+        sample = df.sample(PROFILE_ROWS, random_state=0)
+    est = "~" if sample is not df else ""
+    nulls = df.isna().sum()
+    stats = []
+    for pos, c in enumerate(df.columns):
+        col = df.iloc[:, pos]
+        part = sample.iloc[:, pos]
+        exact = pd.api.types.is_numeric_dtype(col) or pd.api.types.is_datetime64_any_dtype(col)
+        low, high = (col, "") if exact else (part, est)
+        try:
+            lo, hi = low.min(), low.max()
+        except TypeError:  # mixed value types
+            lo, hi = "", ""
+        if est:
+            distinct = "~{:,}".format(hll_distinct(col))
+        else:
+            distinct = "{:,}".format(col.nunique())
+        top = part.value_counts().head(3)
+        tops = ", ".join("{} ({:.0%})".format(v, k / max(len(part), 1)) for v, k in top.items())
+        if exact:
+            mem = col.memory_usage(index=False, deep=False)
+        else:
+            mem = part.memory_usage(index=False, deep=True) * n / max(len(part), 1)
+        stats.append((str(c), str(col.dtype), "{:,}".format(nulls.iloc[pos]), distinct,
+                      high + str(lo), high + str(hi), est + tops, size_text(mem)))
+    return stats
+
+
+def hll_distinct(col, p=14):
+    '''
+    HyperLogLog estimate of the distinct values in a column (about 1% off)
+    computed with vectorized hashing instead of a set of all the values
+    '''
+    h = pd.util.hash_pandas_object(col.dropna(), index=False).to_numpy()
+    if len(h) == 0:
+        return 0
+    m = 1 << p
+    reg = (h >> np.uint64(64 - p)).astype(np.int64)  # register from the first p bits
+    rest = (h & np.uint64((1 << (64 - p)) - 1)).astype(np.float64)  # < 2**50 - exact in a float
+    rank = (64 - p) - np.frexp(rest)[1] + 1  # leading zeros of the other bits + 1
+    regs = np.zeros(m)
+    best = pd.Series(rank).groupby(reg).max()
+    regs[best.index.to_numpy()] = best.to_numpy()
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(2.0 ** -regs)
+    zeros = np.count_nonzero(regs == 0)
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * np.log(m / zeros)  # small range correction
+    return int(round(estimate))
+
+
+def size_text(nbytes):
+    ''' 1536 -> 1.5 KB '''
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            return "{:.1f} {}".format(nbytes, unit) if unit != "B" else "{} B".format(int(nbytes))
+        nbytes /= 1024
+
+
+def show_profile():
+    ''' Table Info popup - column profile of the last SQL result '''
+    tl = Toplevel()
+    tl.wm_title("Info - {:,} rows, {} cols".format(*DF.shape))
+    heads = ('column', 'type', 'nulls', 'distinct', 'min', 'max', 'top values', 'memory')
+    tree = Treeview(tl, columns=heads, show='headings', height=min(max(len(DF.columns), 3), 25))
+    for h in heads:
+        tree.heading(h, text=h)
+        tree.column(h, width=220 if h == 'top values' else 90, stretch=True)
+    tree.pack(side="top", fill="both", expand=True, padx=5, pady=5)
+    slot = PROFILE
+
+    def fill():
+        if not tl.winfo_exists():
+            return
+        if slot['table'] is None:
+            tl.after(200, fill)  # still profiling
+            return
+        if isinstance(slot['table'], Exception):
+            tree.insert('', END, values=("profile failed", str(slot['table'])))
+            return
+        for row in slot['table']:
+            tree.insert('', END, values=row)
+
+    fill()
+
+
 #
 # Functions to handle SQL execution
 #
 
-def create_df(filename, n, dates):
+def timed(step, t0):
+    ''' add the seconds since t0 to this thread's timing of an exec_sql step '''
+    TIMES.steps[step] = TIMES.steps.get(step, 0.0) + time.perf_counter() - t0
+
+
+def clean_columns(df):
+    ''' usable sql column names: poorly formed names are re-constructed in place '''
+    df.columns = clean_names(df.columns)
+
+
+def clean_names(names):
+    ''' lower case, _ for spaces and dashes, no parentheses: "Order Date (UTC)" -> order_date_utc '''
+    return pd.Index(names).str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_').str.replace('(', '').str.replace(')', '')
+
+
+def create_df(filename, n, dates, keep=None):
     '''
     Reads datafile and returns a Pandas DataFrame object
     Limited to one sheet per file request
     n is either named sheet or zero (0 meaning 1st sheet in the workbook)
     Sheet info is irrevelant for csv files
     n is the table name for sqlite files!
+    A glob pattern or directory reads all its files as one table (create_multi),
+    keep is the partition filter for those (see partition_filter)
     '''
     try:
-        if filename.endswith('xlsx') or filename.endswith('xls'):
-            if n.isnumeric():
-                # df = pd.read_excel(filename, sheet_name=int(n), parse_dates=dates)  # , parse_dates=True
-                # Load spreadsheet
-                df = pd.ExcelFile(filename).parse(sheet_name=int(n), parse_dates=dates)
-            else:
-                df = pd.ExcelFile(filename).parse(n, parse_dates=dates)
-            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_').str.replace('(', '').str.replace(')', '')
-        elif filename.endswith('csv'):
-            df = pd.read_csv(filename, parse_dates=dates, encoding='utf-8')
-            df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_').str.replace('(', '').str.replace(')', '')
-        else:
-            engine = create_engine('sqlite:///' + filename, echo=False)  # , encoding='utf-8'
-            conn = engine.connect()
-            df = pd.read_sql_table(n, conn, parse_dates=dates)
-            conn.close()
-        return df
+        if is_multi(filename):
+            return create_multi(filename, n, dates, keep or {})
+        return read_file(filename, n, dates)
     except Exception as e:
         route_msg("Input Problem", e, "error")
 
 
+def read_file(filename, n, dates):
+    ''' Reads one datafile - see create_df '''
+    if filename.endswith('xlsx') or filename.endswith('xls'):
+        if is_sheet_set(n):
+            with open(filename, 'rb') as fh:
+                data = fh.read()
+            book = pd.ExcelFile(io.BytesIO(data), engine=XLSX_ENGINE)
+            if n not in book.sheet_names:
+                return read_sheets(data, book, n, dates)
+            # a sheet really is named like a selector: 2023-2024, "Sales, East"
+            df = book.parse(n, parse_dates=dates)
+            book.close()
+        elif n.isnumeric():
+            # df = pd.read_excel(filename, sheet_name=int(n), parse_dates=dates)  # , parse_dates=True
+            # Load spreadsheet
+            df = pd.ExcelFile(filename).parse(sheet_name=int(n), parse_dates=dates)
+        else:
+            df = pd.ExcelFile(filename).parse(n, parse_dates=dates)
+        clean_columns(df)
+    elif filename.lower().endswith(COMPRESSED):
+        df = read_stream(filename, n, dates)
+    elif filename.endswith('csv'):
+        df = pd.read_csv(filename, parse_dates=dates, encoding='utf-8')
+        clean_columns(df)
+    elif data_ext(filename) == '.parquet':
+        df = pd.read_parquet(filename)
+        clean_columns(df)
+    elif data_ext(filename) in JSON_LINES:
+        df = pd.read_json(filename, lines=True, convert_dates=dates)
+        clean_columns(df)
+    else:
+        engine = create_engine('sqlite:///' + filename, echo=False)  # , encoding='utf-8'
+        conn = engine.connect()
+        df = pd.read_sql_table(n, conn, parse_dates=dates)
+        conn.close()
+    return df
+
+
+def data_ext(filename):
+    ''' extension of the data under a compression suffix: sales.csv.gz -> .csv '''
+    stem, ext = os.path.splitext(filename.lower())
+    if ext in COMPRESSED:
+        return os.path.splitext(stem)[1]
+    return ext
+
+
+def read_stream(filename, n, dates):
+    '''
+    Reads a compressed csv, json lines or parquet file, or one inside a zip.
+    The data is decompressed while pandas parses it - never to a temp file.
+    For a zip n names the member (or its number among the data files, 0 = first)
+    '''
+    fh, kind = open_input(filename, n)
+    with fh:
+        if kind == '.csv':
+            df = pd.read_csv(fh, parse_dates=dates, encoding='utf-8')
+        elif kind in JSON_LINES:
+            df = pd.read_json(fh, lines=True, convert_dates=dates)
+        elif kind == '.parquet':
+            df = pd.read_parquet(io.BytesIO(fh.read()))  # parquet needs random access
+        else:
+            raise ValueError("Can not read a {} file in {}".format(kind or "plain", filename))
+    clean_columns(df)
+    return df
+
+
+def open_input(filename, n="0"):
+    '''
+    binary stream of the decompressed data of an Input file and the extension
+    of that data. gzip uses python-isal's threaded reader when it is installed,
+    every other codec is decompressed in a ReadAhead thread.
+    '''
+    ext = os.path.splitext(filename.lower())[1]
+    kind = data_ext(filename)
+    if ext == '.zip':
+        zf = zipfile.ZipFile(filename)
+        names = [i.filename for i in zf.infolist()
+                 if not i.is_dir() and data_ext(i.filename) in DATA_FILES]
+        if n.isnumeric():
+            if int(n) >= len(names):
+                raise FileNotFoundError("{} has no data file number {}".format(filename, n))
+            name = names[int(n)]
+        else:
+            name = n
+        stream, kind = zf.open(name), data_ext(name)
+    elif ext == '.gz':
+        try:
+            from isal import igzip_threaded
+            return igzip_threaded.open(filename, 'rb', threads=1), kind
+        except ImportError:
+            stream = gzip.open(filename, 'rb')
+    elif ext == '.bz2':
+        stream = bz2.open(filename, 'rb')
+    elif ext == '.xz':
+        stream = lzma.open(filename, 'rb')
+    else:  # .zst
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("reading .zst files needs the zstandard package")
+        stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    return io.BufferedReader(ReadAhead(stream), READ_AHEAD), kind
+
+
+class ReadAhead(io.RawIOBase):
+    '''
+    Reads a decompressing stream in a background thread. zlib, bz2, lzma and
+    zstandard release the GIL, so decompression overlaps the csv parsing.
+    '''
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.blocks = queue.Queue(maxsize=4)
+        self.stop = threading.Event()
+        self.left = memoryview(b"")
+        self.eof = False
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stop.is_set():
+                block = self.stream.read(READ_AHEAD)
+                self.put(block)  # b"" marks the end
+                if not block:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass  # the reader is busy - or gone, then stop is set
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.left:
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.left = memoryview(item)
+        size = min(len(buf), len(self.left))
+        buf[:size] = self.left[:size]
+        self.left = self.left[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+def is_sheet_set(n):
+    ''' sheet line of an Input may select several sheets: * or a list or a range (0-3) - see read_file '''
+    return n.strip() == "*" or "," in n or re.fullmatch(r"\s*\d+\s*-\s*\d+\s*", n) is not None
+
+
+def sheet_list(n, names):
+    ''' sheet names picked by a sheet selector: *  /  Jan,Feb,3  /  0-3 '''
+    if n.strip() == "*":
+        return list(names)
+    picked = []
+    for item in n.split(","):
+        item = item.strip()
+        span = re.fullmatch(r"(\d+)\s*-\s*(\d+)", item)
+        if span:
+            picked += names[int(span.group(1)):int(span.group(2)) + 1]
+        elif item.isnumeric():
+            picked.append(names[int(item)])
+        elif item in names:
+            picked.append(item)
+        else:
+            raise ValueError("Worksheet named '{}' not found".format(item))
+    return picked
+
+
+def read_sheets(data, book, n, dates):
+    '''
+    Reads the selected sheets of a workbook into one DataFrame with a
+    sheet_name column. data is the file read from disk once and book the
+    open workbook over it (read_file). With python-calamine
+    installed the sheets are parsed concurrently, each thread with its own
+    reader over the same bytes. openpyxl parses in Python holding the GIL, so
+    without calamine the sheets are parsed one after the other from the one
+    open workbook - threads only made that slower.
+    '''
+    sheets = sheet_list(n, book.sheet_names)
+
+    def read(sheet):
+        if XLSX_ENGINE == 'calamine':
+            df = pd.read_excel(io.BytesIO(data), sheet_name=sheet, parse_dates=dates, engine='calamine')
+        else:
+            df = book.parse(sheet, parse_dates=dates)
+        clean_columns(df)
+        df['sheet_name'] = sheet
+        return df
+
+    if XLSX_ENGINE == 'calamine' and len(sheets) > 1:
+        with ThreadPoolExecutor(max_workers=min(INPUT_WORKERS, len(sheets))) as pool:
+            frames = list(pool.map(read, sheets))
+    else:
+        frames = [read(s) for s in sheets]
+    book.close()
+    return pd.concat(frames, ignore_index=True)
+
+
+def is_multi(filename):
+    ''' Input path names several files: a glob pattern or a directory - an existing file never is '''
+    if os.path.isfile(filename):
+        return False  # export[1].csv is that file, not a pattern
+    return any(ch in filename for ch in "*?[") or os.path.isdir(filename)
+
+
+def multi_files(filename):
+    ''' the data files of a glob or directory Input path in name order '''
+    if os.path.isdir(filename):
+        found = [os.path.join(d, f) for d, dirs, files in os.walk(filename)
+                 for f in files if data_ext(f) in DATA_FILES or f.lower().endswith('.zip')]
+    else:
+        found = [f for f in glob.glob(filename, recursive=True) if os.path.isfile(f)]
+    return sorted(found)
+
+
+def multi_root(filename):
+    ''' folder a glob or directory Input path starts from '''
+    if os.path.isdir(filename):
+        return filename
+    return os.path.dirname(re.split(r"[*?\[]", filename)[0]) or "."
+
+
+def partitions(path, root):
+    ''' key=value folder names between root and the file: {'year': '2026'} '''
+    parts = {}
+    for folder in os.path.relpath(os.path.dirname(path), root).split(os.sep):
+        if "=" in folder:
+            k, v = folder.split("=", 1)
+            parts[k.strip().lower().replace(' ', '_').replace('-', '_')] = v
+    return parts
+
+
+def create_multi(pattern, n, dates, keep):
+    '''
+    Reads every file of a glob or directory Input in parallel into one DataFrame.
+    source_file holds the file name and every key=value folder becomes a column.
+    Files in partitions the sql excludes (keep) are not read at all.
+    '''
+    root = multi_root(pattern)
+    files = []
+    for f in multi_files(pattern):
+        parts = partitions(f, root)
+        if all(same_value(parts[k], vals) for k, vals in keep.items() if k in parts):
+            files.append((f, parts))
+    if not files:
+        raise FileNotFoundError("No files to read for " + pattern)
+
+    def read(item):
+        f, parts = item
+        df = read_file(f, n, dates)
+        df['source_file'] = os.path.relpath(f, root)
+        for k, v in parts.items():
+            df[k] = v
+        return df
+
+    with ThreadPoolExecutor(max_workers=min(INPUT_WORKERS, len(files))) as pool:
+        df = pd.concat(list(pool.map(read, files)), ignore_index=True)
+    for k in files[0][1]:
+        try:
+            df[k] = pd.to_numeric(df[k])  # year=2026 -> 2026
+        except (ValueError, TypeError):
+            pass
+    logging.debug("{}: {} files read".format(pattern, len(files)))
+    return df
+
+
+def same_value(value, allowed):
+    ''' partition folder value is one of the allowed sql literals ('07' = 7) '''
+    for a in allowed:
+        if value == a:
+            return True
+        try:
+            if float(value) == float(a):
+                return True
+        except ValueError:
+            pass
+    return False
+
+
+def partition_filter(queries, tbl):
+    '''
+    Column values every sql block reading table tbl asks for in its WHERE:
+    WHERE year = 2026 or year IN (2025, 2026) gives {'year': {'2025', '2026'}}.
+    Only plain AND-ed conditions count - OR, NOT, subqueries or a block
+    without the column in its WHERE mean that column is not filtered.
+    '''
+    keep = None
+    for query in queries:
+        sql = query['sql_code'].lower()
+        if not re.search(r'\b' + re.escape(tbl.lower()) + r'\b', sql):
+            continue  # this block does not read the table
+        if sql.count("select") != 1:
+            return {}
+        where = re.search(r"\bwhere\b(.*?)(\bgroup\s+by\b|\border\s+by\b|\blimit\b|\bhaving\b|\bunion\b|$)",
+                          sql, re.S)
+        if where is None or re.search(r"\b(or|not)\b", where.group(1)):
+            return {}
+        names = {tbl.lower()}  # the table and its alias may qualify a column
+        for alias in re.findall(r'\b(?:from|join)\s+"?' + re.escape(tbl.lower()) + r'"?\s+(?:as\s+)?(\w+)', sql):
+            names.add(alias)
+        found = {}
+        literal = r"('[^']*'|-?\d+(?:\.\d+)?)"
+        for q, col, val in re.findall(r'(?:(\w+)\.)?"?(\w+)"?\s*=\s*' + literal, where.group(1)):
+            if q == "" or q in names:
+                found.setdefault(col, set()).add(val.strip("'"))
+        for q, col, vals in re.findall(r'(?:(\w+)\.)?"?(\w+)"?\s+in\s*\(([^)]*)\)', where.group(1)):
+            if q == "" or q in names:
+                found.setdefault(col, set()).update(v.strip().strip("'") for v in vals.split(","))
+        if keep is None:
+            keep = found
+        else:  # a file is needed if any block wants it
+            keep = {k: keep[k] | found[k] for k in keep if k in found}
+    return keep or {}
+
+
 def display_results(df):
     '''
-    Create a string holding the new df info
-        popup window uses this string
-            and
     display the new SQL result (df) in the output Text widget
+    and start the column profile the Table Info popup shows
     '''
-    global tbl_info
     global DF
     if RUN_CONSOLE:
         print(df)
     else:
-        buf = io.StringIO()
-        df.info(verbose=True, buf=buf)  # show_counts for Windows
-        tbl_info = buf.getvalue()  # holds df.info string
-        lst = tbl_info.split("\n")
-        x = lst[1]
-        rows = between(x, "RangeIndex: ", " entries")
-        y = lst[2]
-        cols = between(y, "Data columns (total ", " columns):")
-        tblinfo = "{} rows, {} cols".format(rows, cols)
-        var_bottom.set(tblinfo)
+        var_bottom.set("{} rows, {} cols".format(*df.shape))
         txt.delete("1.0", END)
         txt.insert("1.0", df)
         txt.insert(END, "\n")
         DF = df.copy()
+        start_profile(DF)
         frm_out.config(text="     SQL Output ")
 
 
@@ -406,6 +1102,7 @@ def processCodeFile(e=None):
     "Execute" button was clicked
     Obtain the sql code file content for processing
     '''
+    load_modules()
     if RUN_CONSOLE is True:
         with open(SQL_file) as fh:
             sql = fh.read()
@@ -439,7 +1136,7 @@ def processCodeFile(e=None):
                 else:
                     route_msg("Invalid Selection", "Preview only CSV and XLS(X) files", "error")
                     return  # preview of Sqlite is not implemented
-                df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('-', '_').str.replace('(', '').str.replace(')', '')
+                clean_columns(df)
                 # display the whole table (df)
                 txt.insert(END, df)
                 txt.insert(END, "\n")
@@ -450,31 +1147,36 @@ def processCodeFile(e=None):
     if RUN_CONSOLE is False:
         frm_out.config(text=" P r o c e s s i n g . . . ")
         frm_out.update()
-
-    exec_sql(sql)
+        exec_sql(sql, limit=int(rows_))  # Rows in sqlcel.ini - 0 shows all rows
+    else:
+        exec_sql(sql)
 
 ########################################################################
 
-def exec_sql(sql):
+def parse_code(sql):
     '''
-    Setup the spreadsheet with pandas and sqlalchemy then execute the users sql statement
-    display result in GUI and optional output to excel or csv
+    Primitive parsing of the code file text into its sections
+    returns a dict of the sections - 'error' is set when the code is not usable
+    A code file may hold several sql blocks - each one can have its own Output.
+    "sql name" also saves the result as table name for the blocks after it.
+    An Index section lists "table col1,col2" lines - indexes made after loading.
+    A Params section lists "name = default" lines - bound to :name in the sql.
     '''
-   # PARSE CODE FILE TO SETUP VARIABLE LISTS
-
     parser = 9  # flag for primitive parsing logic
 
-    sql_file = []  # list of lines of code
-    sql_code = ""  # just the SQL select statement
-    sql_infile = []
-    sql_sheet = []
-    sql_tbl = []  # sheet number 0 default
-    outpath = None
-    datelist = None  # date reformating
-
-    sql_file = sql.split("\n")
+    spec = {'infile': [],     # input file paths
+            'sheet': [],      # sheet number 0 default
+            'tbl': [],        # table names
+            'dates': None,    # date reformating
+            'indexes': [],    # (table, [columns]) from the Index section
+            'params': {},     # :name bind parameters and their defaults
+            'queries': [],    # sql blocks in code file order (new_query)
+            'error': None}
+    query = None  # sql block being read
+    out = None  # sql block (or first_out) the Output lines go to
+    first_out = new_query(None)  # Output before any sql block: for the last block
 
-    for line in sql_file:
+    for line in sql.split("\n"):
 
         ln = line.strip()
 
@@ -485,33 +1187,61 @@ def exec_sql(sql):
         if ln[-1:] == ";":
             ln = ln[:-1]
 
-        if parser == 11:  # Sql code must be LAST in code file
-            sql_code = sql_code + ln + "\n"
+        if ln.lower() == "sql" or ln.lower().startswith("sql "):
+            query = new_query(ln[4:].strip() or None)
+            spec['queries'].append(query)
+            parser = 11
             continue
 
         if ln.lower() == "output":
-            if outpath is not None:
-                route_msg("SQL File", "Only 1 'output;' path allowed", "error")
-                return
+            out = first_out if query is None else query
+            if out['outpath'] is not None:
+                spec['error'] = "Only 1 'output;' path allowed per sql block"
+                return spec
             parser = 8
             continue
 
+        if ln.lower() == "index":
+            parser = 13
+            continue
+
+        if ln.lower() == "params":
+            parser = 14
+            continue
+
+        if parser == 11:  # everything up to the next sql, output, index or params line is sql
+            query['sql_code'] = query['sql_code'] + ln + "\n"
+            continue
+
         if parser == 8:
-            outpath = ln
-            parser = 9
+            out['outpath'] = ln
+            parser = 12  # optional table / append / upsert lines may follow
             continue
 
+        if parser == 12:
+            if ln.lower().startswith("table "):
+                out['outtable'] = ln[6:].strip()
+                continue
+            if ln.lower() == "append":
+                out['outmode'] = 'append'
+                continue
+            if ln.lower().startswith("upsert "):
+                out['outmode'] = 'upsert'
+                out['outkeys'] = [k.strip() for k in ln[7:].split(',')]
+                continue
+            parser = 9
+
         if ln.lower() == "input":
             parser = 0
             continue
 
         if 0 <= parser <= 2:
             if parser == 0:
-                sql_infile.append(ln)
+                spec['infile'].append(ln)
             elif parser == 1:
-                sql_sheet.append(ln)
+                spec['sheet'].append(ln)
             elif parser == 2:
-                sql_tbl.append(ln)
+                spec['tbl'].append(ln)
                 parser = 9  # done with this input file request
                 continue
             parser += 1
@@ -521,107 +1251,1575 @@ def exec_sql(sql):
             continue
 
         if parser == 10:
-            datelist = ln.split(',')  # dates,dates,... to List
+            spec['dates'] = ln.split(',')  # dates,dates,... to List
             parser = 9
             continue
 
-        if ln.lower() == "sql":
-            parser = 11
+        if parser == 13:  # table col1,col2 - until the next section
+            parts = ln.split(None, 1)
+            if len(parts) < 2:
+                spec['error'] = "Index lines are: table col1,col2"
+                return spec
+            spec['indexes'].append((parts[0], [c.strip() for c in parts[1].split(',')]))
             continue
 
-    if len(sql_infile) != len(sql_sheet) or len(sql_sheet) != len(sql_tbl):
-        route_msg("SQL File", "Something wrong with input declarations", "error")
-        return
-    if not sql_code.lower().lstrip().startswith("select"):
-        route_msg("SQL File", "Code missing in one or more sections.", "error")
-        print(sql_code)
+        if parser == 14:  # name = default - until the next section
+            name, _, value = ln.partition("=")
+            spec['params'][name.strip().lstrip(":")] = param_value(value) if value.strip() else None
+            continue
+
+    if spec['queries'] and first_out['outpath'] is not None:
+        last = spec['queries'][-1]
+        if last['outpath'] is not None:
+            spec['error'] = "Only 1 'output;' path allowed per sql block"
+            return spec
+        for k in ('outpath', 'outtable', 'outmode', 'outkeys'):
+            last[k] = first_out[k]
+
+    if len(spec['infile']) != len(spec['sheet']) or len(spec['sheet']) != len(spec['tbl']):
+        spec['error'] = "Something wrong with input declarations"
+    elif not spec['queries'] or not all(q['sql_code'].lower().lstrip().startswith("select")
+                                        for q in spec['queries']):
+        spec['error'] = "Code missing in one or more sections."
+    elif any(q['name'] in spec['tbl'] for q in spec['queries']):
+        spec['error'] = "A sql block has the name of an Input table"
+
+    if spec['dates'] == None:  # No date cols declared in the code file
+        spec['dates'] = True
+
+    return spec
+
+
+def param_value(text):
+    ''' a Params default or parameter table value as int, float or text '''
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] and text[0] in "'\"":
+        return text[1:-1]  # quoted: always text
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def new_query(name):
+    ''' one sql block of a code file and its optional Output '''
+    return {'name': name,       # table name for the result - None if not kept
+            'sql_code': "",     # just the SQL select statement
+            'outpath': None,    # optional output file
+            'outtable': None,   # sqlite output: table name (table1)
+            'outmode': None,    # sqlite output: None replace, 'append' or 'upsert'
+            'outkeys': []}      # sqlite output: upsert key columns
+
+
+def select_star(sql_code):
+    ''' True when the select statement asks for all columns '*' '''
+    try:
+        cols = between(sql_code, "select ", " from ")
+    except ValueError:
+        return False
+    return cols.strip() == "*"
+
+
+def file_stamp(filename):
+    '''
+    modified time and size of a file - None if it is not there (yet)
+    for a glob or directory Input the stamps of all its files
+    '''
+    if is_multi(filename):
+        # a file gone between the listing and its stat just has no stamp
+        return tuple((f,) + (file_stamp(f) or ()) for f in multi_files(filename))
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def csv_mark(filename, stamp):
+    '''
+    Remember where a fully loaded csv file ended so appended rows can be
+    read later without re-reading the file. None when the file did not end
+    on a complete line (the next change then reloads the whole file).
+    '''
+    if stamp is None or is_multi(filename) or stamp[1] == 0 or not filename.lower().endswith('csv'):
+        return None
+    with open(filename, 'rb') as fh:
+        head = fh.read(min(4096, stamp[1]))
+        fh.seek(stamp[1] - 1)
+        if fh.read(1) != b"\n":
+            return None
+    return {'offset': stamp[1], 'head': head}
+
+
+def append_csv(engine, tbl, info, stamp, dates):
+    '''
+    Insert only the new tail rows of a csv file that has grown since it was loaded.
+    returns False when the file was rewritten and has to be reloaded in full
+    '''
+    mark = info['mark']
+    if mark is None or stamp is None or stamp[1] <= mark['offset']:
+        return False
+    with open(info['key'][0], 'rb') as fh:
+        if fh.read(len(mark['head'])) != mark['head']:
+            return False  # not the same file anymore
+        fh.seek(mark['offset'])
+        chunk = fh.read(stamp[1] - mark['offset'])
+    cut = chunk.rfind(b"\n") + 1  # only complete lines - the writer may still be busy
+    if cut > 0:
+        if isinstance(dates, list):
+            dates = list(clean_names(dates))  # datecols name the raw header, the columns are cleaned
+        df = pd.read_csv(io.BytesIO(chunk[:cut]), header=None, names=info['columns'],
+                         parse_dates=dates, encoding='utf-8')
+        df.index = range(info['rows'], info['rows'] + len(df))  # continue the index column
+        df.to_sql(tbl, con=engine, if_exists='append', index=True)
+        info['rows'] += len(df)
+        mark['offset'] += cut
+    info['stamp'] = stamp
+    return True
+
+
+def input_bytes(spec):
+    '''
+    rough RAM needed to load the Inputs of a code file: the size of each file
+    times INPUT_FACTOR for its type (a DataFrame plus its in-memory SQLite copy)
+    '''
+    total = 0
+    for filename in spec['infile']:
+        files = multi_files(filename) if is_multi(filename) else [filename]
+        for f in files:
+            try:
+                size = os.path.getsize(f)
+            except OSError:
+                continue  # create_df reports the missing file
+            if f.lower().endswith(COMPRESSED):
+                size *= 5  # typical csv / json compression ratio
+            total += size * INPUT_FACTOR.get(data_ext(f), 3)
+    return total
+
+
+def work_engine(spec, drop=True):
+    '''
+    SQL engine for one run: in memory, or a scratch database file when
+    the Inputs would not fit in the memory Budget of sqlcel.ini or when
+    parallel aggregation is on (its worker connections need a file)
+    drop=False keeps the earlier scratch files - Explain must not take the
+    engine of the result on display
+    '''
+    if drop:
+        drop_scratch()  # the previous run's scratch file is not needed anymore
+    if WORKERS > 1 or PARALLEL_SET:
+        return scratch_engine()
+    need = input_bytes(spec)
+    if BUDGET <= 0 or need <= BUDGET:
+        # return create_engine('sqlite://', echo=False, encoding='utf-8')
+        return create_engine('sqlite://', echo=False)
+    logging.debug("inputs need about {} - over the {} budget, using a scratch database".format(
+                  size_text(need), size_text(BUDGET)))
+    return scratch_engine()
+
+
+def scratch_engine():
+    '''
+    file backed SQLite engine in the temp directory, tuned as a throw away
+    work area: no journal or syncs, a bounded page cache and the file memory mapped
+    '''
+    from sqlalchemy import event
+    fd, path = tempfile.mkstemp(prefix="sqlcel_", suffix=".db")
+    os.close(fd)
+    engine = create_engine('sqlite:///' + path, echo=False)
+    event.listen(engine, "connect", tune_scratch)
+    SCRATCH[engine] = path
+    return engine
+
+
+def tune_scratch(dbapi_conn, record=None):
+    ''' PRAGMAs of every scratch database connection (engine and parallel workers) '''
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA temp_store = FILE")  # sorts and temp b-trees spill to disk too
+    cur.execute("PRAGMA cache_size = -%d" % (SCRATCH_CACHE * 1024))  # negative: KiB
+    cur.execute("PRAGMA mmap_size = %d" % (SCRATCH_MMAP * 1024 * 1024))
+    cur.close()
+
+
+def drop_scratch():
+    ''' close the scratch database engines and delete their files (also at exit) '''
+    global LAST_RUN
+    for engine in list(SCRATCH):
+        if MORE is not None and MORE.get('engine') is engine:
+            close_more()
+        if LAST_RUN is not None and LAST_RUN['engine'] is engine:
+            LAST_RUN = None
+        drop_engine(engine)
+
+
+def drop_engine(engine):
+    ''' close an engine and delete its scratch database file if it has one '''
+    engine.dispose()
+    path = SCRATCH.pop(engine, None)
+    if path is not None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+atexit.register(drop_scratch)
+
+
+def spill_csv(engine, tbl, filename, n, dates):
+    '''
+    Insert a csv file into the scratch database SPILL_ROWS rows at a time
+    so the whole file never is in memory as one DataFrame
+    returns the column names and the row count like a loaded DataFrame
+    '''
+    rows = 0
+    columns = None
+    if filename.lower().endswith(COMPRESSED):
+        source = open_input(filename, n)[0]  # decompressed as the chunks are read
+    else:
+        source = open(filename, 'rb')
+    with source, pd.read_csv(source, parse_dates=dates, encoding='utf-8', chunksize=SPILL_ROWS) as reader:
+        for df in reader:
+            clean_columns(df)
+            df.index = range(rows, rows + len(df))  # one index column across the chunks
+            df.to_sql(tbl, con=engine, if_exists='replace' if columns is None else 'append',
+                      index=True, chunksize=SQLITE_CHUNK)
+            columns = list(df.columns)
+            rows += len(df)
+    return columns, rows
+
+
+def spills(engine, filename):
+    ''' a single csv Input going into a scratch database is read in chunks '''
+    return engine in SCRATCH and not is_multi(filename) and data_ext(filename) == '.csv'
+
+
+def load_inputs(engine, spec, loaded):
+    '''
+    Input files are converted to DataFrames and registered as SQL tables.
+    loaded holds what earlier runs already put in the engine (watch mode):
+    unchanged files are skipped and appended csv rows are added in place.
+    returns False if an input could not be loaded
+    '''
+    for x in range(0, len(spec['tbl'])):
+        filename = spec['infile'][x]
+        tbl = spec['tbl'][x]
+        keep = {}
+        if is_multi(filename):
+            keep = partition_filter(spec['queries'], tbl)  # partitions the sql can skip
+        key = (filename, spec['sheet'][x], str(spec['dates']), str(sorted(keep.items())))
+        stamp = file_stamp(filename)
+        info = loaded.get(tbl)
+        if info is not None and info['key'] == key:
+            if info['stamp'] == stamp:
+                continue  # nothing changed since the last run
+            if append_csv(engine, tbl, info, stamp, spec['dates']):
+                continue
+        t0 = time.perf_counter()
+        if spills(engine, filename):
+            try:
+                columns, rows = spill_csv(engine, tbl, filename, spec['sheet'][x], spec['dates'])
+            except Exception as e:
+                route_msg("Input Problem", e, "error")
+                loaded.pop(tbl, None)
+                return False
+            timed('to_sql', t0)
+        else:
+            dataframe = create_df(filename, spec['sheet'][x], spec['dates'], keep)
+            if dataframe is None:
+                loaded.pop(tbl, None)
+                return False
+            timed('create_df', t0)
+            t0 = time.perf_counter()
+            dataframe.to_sql(tbl, con=engine, if_exists='replace', index=True,
+                             chunksize=SQLITE_CHUNK if engine in SCRATCH else None)
+            timed('to_sql', t0)
+            columns, rows = list(dataframe.columns), len(dataframe)
+            del dataframe  # the table is in SQLite now - free the DataFrame before the next Input
+        mark = None
+        if stamp == file_stamp(filename):  # file did not move while reading it
+            mark = csv_mark(filename, stamp)
+        loaded[tbl] = {'key': key,
+                       'stamp': stamp,
+                       'columns': columns,
+                       'rows': rows,
+                       'mark': mark}
+    return True
+
+
+def exec_sql(sql, engine=None, loaded=None, show=True, limit=0, params=None):
+    '''
+    Setup the spreadsheet with pandas and sqlalchemy then execute the users sql statements
+    display the last result in GUI and optional output to excel or csv for each sql block
+    engine and loaded are passed in by watch and serve mode to keep the tables between runs
+    show=False skips display_results (serve mode sends the result to its client)
+    limit > 0 fetches only that many rows for display, "More" and "Full" get the rest
+    params overrides the Params defaults of the code file (run_params, serve mode)
+    returns the last result DataFrame or None when the run failed
+    '''
+    TIMES.steps = {}
+    t0 = time.perf_counter()
+
+    # PARSE CODE FILE TO SETUP VARIABLE LISTS
+
+    spec = parse_code(sql)
+    timed('parse', t0)
+    if spec['error'] is not None:
+        route_msg("SQL File", spec['error'], "error")
         return
 
-    if datelist == None:  # No date cols declared in the code file
-        datelist = True
+    binds = dict(spec['params'], **(params or {}))
+    global MORE, LAST_RUN
+    close_more()  # an open cursor would keep its tables locked for to_sql
 
     # CONNECT DATAFRAMES TO SQL ENGINE, CREATE TABLES AND EXECUTE SQL
 
-    # engine = create_engine('sqlite://', echo=False, encoding='utf-8')
-    engine = create_engine('sqlite://', echo=False)
+    if engine is None:
+        engine = work_engine(spec)  # in memory unless over the memory Budget
+        loaded = {}
 
-    cols = between(sql_code, "select ", " from ")
-    scols = ""
-    nocomma = False
-    # The following couple small bunches of code clean up the column names
-    # by isolating function "," commas and removing unnecessary whitespace
-    for c in cols:
-        if c == "(":
-            nocomma = True
-        if c == ")":
-            nocomma = False
-        if c == ",":
-            if nocomma is True:
-                c = "^"
-        scols += c
-
-    list_of_cols = scols.split(",")
-    list_of_cols = [i.strip() for i in list_of_cols]  # remove any whitespace around col names
-    list_of_cols = [i.replace("^", ",") for i in list_of_cols]  # handle comma inside of column function
-
-
-    if list_of_cols[0] == "*":
-        # ALL COLUMNS '*' WORKS ONLY WITH ONE FILE REQUEST IN THE CODE FILE
+    t0 = time.perf_counter()
+    if not load_inputs(engine, spec, loaded):
+        return
+    timed('load', t0)
+    if not make_indexes(engine, spec, spec['tbl']):
+        return
+    # Every thing is now ready to run the SQL against the tables
+    notes = []  # one line per output file written
+    for query in spec['queries']:
+        last = query is spec['queries'][-1]
+        sql_code = query['sql_code']
+        t0 = time.perf_counter()
         try:
-            dataframe = create_df(sql_infile[0], sql_sheet[0], datelist)  # return df from file type
-            dataframe.to_sql(sql_tbl[0], con=engine, if_exists='replace', index=True)
+            if query['name'] is not None:
+                # keep the result as a table the later sql blocks can use
+                with engine.begin() as conn:
+                    conn.exec_driver_sql('DROP TABLE IF EXISTS "%s"' % query['name'])
+                    conn.exec_driver_sql('CREATE TABLE "{}" AS {}'.format(query['name'], sql_code), binds)
+                loaded.pop(query['name'], None)  # an Input table of that name has to be loaded again
+                if not make_indexes(engine, spec, [query['name']]):
+                    return
+                if not last and query['outpath'] is None:
+                    timed('query', t0)
+                    continue  # nothing to show or write
+                sql_code = 'SELECT * FROM "%s"' % query['name']
+            final = None
+            if WORKERS > 1 and engine in SCRATCH:
+                final = parallel_frame(engine, sql_code, binds)  # None: the query does not split
+            if final is not None:
+                pass
+            elif last and limit > 0:
+                # interactive run - only the first rows now, the rest on "More"
+                final, rows, close = open_rows(engine, sql_code, limit, binds)
+                if len(final) == limit:
+                    MORE = {'rows': rows, 'engine': engine, 'close': close}
+            else:
+                final = query_frame(engine, sql_code, binds)
+                if select_star(sql_code):
+                    # ALL COLUMNS '*' - leave out the index column added by to_sql
+                    final = final.drop(columns='index', errors='ignore')
+        except Exception as e:
+            route_msg("SQL Syntax Error" + block_name(query, spec), e, "error")
+            return
+        timed('query', t0)
+        if last and not RUN_CONSOLE:
+            LAST_RUN = {'engine': engine, 'sql': sql_code, 'params': binds}
+        if last and show:
+            t0 = time.perf_counter()
+            display_results(final)
+            show_pending()
+            timed('display', t0)
+
+        if last and MORE is not None and query['outpath'] is not None:
+            # the Output file always gets the complete result
+            shown = len(final)
+            final = pd.concat([final, MORE['rows'](None)], ignore_index=True)  # closes the cursor
+            MORE = {'rows': frame_rows(final.iloc[shown:]), 'close': None}
+
+        # The Output; command can specify an output file for the results of the query
+        if query['outpath'] is not None:
+            try:
+                target = query
+                if binds:
+                    # Output path templates: reports/{center}.csv
+                    target = dict(query, outpath=query['outpath'].format(**binds))
+                notes.append(write_output(final, target))
+            except Exception as e:
+                route_msg("Output Problem" + block_name(query, spec), e, "error")
+                return final
+
+    if not notes:
+        if RUN_CONSOLE is True and show:
+            print("no output path")
+    elif WATCHING or not show:
+        logging.debug("Output file refreshed: " + ", ".join(notes))
+    else:
+        route_msg("Finished", "Output file created\n" + "\n".join(notes), "info")
+
+    return final
 
-            with Session(engine) as session:
-               results = pd.read_sql_query(sql_code, session.bind)
-            final = pd.DataFrame(results, columns=dataframe.columns)
 
+def make_indexes(engine, spec, tables):
+    '''
+    create the Index section indexes of these tables (see explain_sql for advice)
+    returns False if one could not be made
+    '''
+    if not spec['indexes']:
+        return True
+    t0 = time.perf_counter()
+    for table, cols in spec['indexes']:
+        if table not in tables:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.exec_driver_sql(index_ddl(table, cols))
         except Exception as e:
-            route_msg("SQL Syntax Error (single sheet)", e, "error")
+            route_msg("Index Problem", "{} {}\n{}".format(table, ",".join(cols), e), "error")
+            return False
+    timed('index', t0)
+    return True
+
+
+def index_ddl(table, cols):
+    ''' CREATE INDEX statement for columns of a table '''
+    name = "ix_{}_{}".format(table, "_".join(cols))
+    return 'CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+        name, table, ", ".join('"%s"' % c for c in cols))
+
+
+def block_name(query, spec):
+    ''' names the sql block in messages when the code file has more than one '''
+    if len(spec['queries']) < 2:
+        return ""
+    return " (sql block {})".format(query['name'] or spec['queries'].index(query) + 1)
+
+
+def write_output(final, query):
+    ''' write a result to the Output file of its sql block - returns a note for the user '''
+    outpath = query['outpath']
+    t0 = time.perf_counter()
+    note = outpath
+    if outpath.endswith("xlsx") or outpath.endswith("xls"):
+        note += " - " + write_xlsx(final, outpath)
+        timed('output_xlsx', t0)
+    elif outpath.lower().endswith("csv"):
+        final.to_csv(outpath, index=False)
+        timed('output_csv', t0)
+    elif query['outtable'] is not None or query['outmode'] is not None:
+        # assuming sqlite - keep the table and its indexes, write only the rows
+        write_sqlite(final, outpath, query['outtable'] or 'table1',
+                     query['outmode'], query['outkeys'])
+        timed('output_sqlite', t0)
+    else:  # assuming sqlite then
+        e = create_engine('sqlite:///' + outpath, echo=False)  # , encoding='utf-8'
+        conn = e.connect()
+        final.to_sql('table1', conn, if_exists='replace')
+        conn.close()
+        timed('output_sqlite', t0)
+    return note
+
+
+def query_frame(engine, sql_code, params=None):
+    '''
+    Run a query and build the result DataFrame through Arrow: the sqlite3
+    cursor rows go batch by batch into column arrays (arrow_batch) and then
+    once into the DataFrame - no row objects, no second DataFrame copy.
+    Falls back to pd.read_sql_query without pyarrow or when a column mixes
+    value types (sqlite allows that, Arrow does not).
+    params are bound to the :name placeholders of the query
+    '''
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql_code, params or {})
+        names = [d[0] for d in cur.description]
+        batches = []
+        while True:
+            rows = cur.fetchmany(ARROW_BATCH)
+            if not rows:
+                break
+            batches.append(arrow_batch(rows, names))
+        return arrow_frame(batches, names)
+    except ARROW_ERRORS:
+        return pd.DataFrame(pd.read_sql_query(sql_code, con=engine, params=params))
+    finally:
+        conn.close()  # back to the engine pool - the tables stay
+
+
+def arrow_batch(rows, names):
+    ''' one Arrow record batch from a list of cursor row tuples '''
+    import pyarrow as pa
+    if not rows:
+        return pa.RecordBatch.from_arrays([pa.array([], pa.null()) for n in names], names=names)
+    return pa.RecordBatch.from_arrays([pa.array(col) for col in zip(*rows)], names=names)
+
+
+def arrow_frame(batches, names):
+    '''
+    DataFrame from Arrow record batches - the column types of the batches
+    are unified first (a batch may have seen only NULLs or only integers)
+    '''
+    import pyarrow as pa
+    if not batches:
+        batches = [arrow_batch([], names)]
+    table = pa.concat_tables([pa.Table.from_batches([b]) for b in batches],
+                             promote_options="permissive")
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def open_rows(engine, sql_code, limit, params=None):
+    '''
+    Execute the query on a DBAPI cursor and fetch only the first limit rows.
+    returns those rows, a function that fetches the next n rows
+    from the still open cursor (all remaining rows when n is None)
+    and a function that closes the cursor and its connection.
+    The cursor closes itself once it is done.
+    '''
+    conn = engine.raw_connection()
+    cur = conn.cursor()
+    cur.execute(sql_code, params or {})
+    cols = [d[0] for d in cur.description]
+    star = select_star(sql_code)
+    is_open = [True]
+
+    def close():
+        if is_open[0]:
+            is_open[0] = False
+            cur.close()  # ends the statement - its read lock blocks DROP TABLE
+            conn.close()  # back to the engine pool
+
+    def rows(n):
+        if n is None:
+            data = cur.fetchall() if is_open[0] else []
+            close()
         else:
-            if not RUN_CONSOLE:
-                display_results(final)
+            data = cur.fetchmany(n) if is_open[0] else []
+            if len(data) < n:
+                close()
+        try:
+            df = arrow_frame([arrow_batch(data, cols)], cols)
+        except ARROW_ERRORS:
+            df = pd.DataFrame.from_records(data, columns=cols)
+        if star:
+            df = df.drop(columns='index', errors='ignore')
+        return df
 
-    else:  # WHEN MULTIPLE FILE REQUESTS APPEAR IN YOUR CODE - SQL STATEMENT MUST CONTAIN COLUMN NAMES
+    return rows(limit), rows, close
 
-        # Input files are converted to DataFrames and registered as SQL tables
-        for x in range(0, len(sql_tbl)):
-            dataframe = create_df(sql_infile[x], sql_sheet[x], datelist)
-            dataframe.to_sql(sql_tbl[x], con=engine, if_exists='replace', index=True)
-            # Every thing is now ready to run the SQL against the tables
+
+def frame_rows(df):
+    ''' same as the rows function of open_rows for rows already in memory '''
+    pos = [0]
+
+    def rows(n):
+        start = pos[0]
+        pos[0] = len(df) if n is None else start + n
+        return df.iloc[start:pos[0]]
+
+    return rows
+
+
+def full_result():
+    '''
+    the whole result of the last Execute - rows still pending for More / Full
+    are fetched now and kept for those buttons, the query does not run again
+    '''
+    global MORE
+    if MORE is None:
+        return DF
+    shown = len(DF)
+    df = pd.concat([DF, MORE['rows'](None)], ignore_index=True)  # closes the cursor
+    MORE = {'rows': frame_rows(df.iloc[shown:]), 'close': None}
+    return df
+
+
+def close_more():
+    ''' forget the pending rows - an open cursor is closed so its tables can change again '''
+    global MORE
+    if MORE is not None and MORE.get('close') is not None:
+        MORE['close']()
+    MORE = None
+
+
+def save_result():
+    ''' Save As button - write the last result to a file in a background thread '''
+    load_modules()  # pressed before the first run pandas may still be unloaded
+    if not isinstance(DF, pd.DataFrame):
+        route_msg("Save Result As", "Execute a query first", "warning")
+        return
+    outpath = filedialog.asksaveasfilename(defaultextension=".csv",
+                                           filetypes=(("CSV text", "*.csv"),
+                                                      ("Excel", "*.xlsx"),
+                                                      ("Sqlite", "*.sqlite *.db"),
+                                                      ("Parquet", "*.parquet")))
+    if not outpath:
+        return
+    df = full_result()
+    tl = Toplevel()
+    tl.wm_title("Save Result As")
+    Label(tl, text="{} - {:,} rows".format(os.path.basename(outpath), len(df))).pack(padx=10, pady=5)
+    bar = Progressbar(tl, maximum=max(len(df), 1), length=300)
+    bar.pack(padx=10, pady=10)
+    state = {'rows': 0, 'note': None, 'error': None}
+
+    def work():
         try:
-            # results = engine.execute(sql_code)
-            #with Session(engine) as session:
-               #results = pd.read_sql_query(sql_code, session.bind)
-            results = pd.read_sql_query(sql_code, con=engine)
-            final = pd.DataFrame(results)
+            state['note'] = save_frame(df, outpath, lambda n: state.update(rows=n))
         except Exception as e:
-            route_msg("SQL Syntax Error (multiple sheets)", e, "error")
+            state['error'] = e
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+
+    def poll():
+        bar['value'] = state['rows']
+        if worker.is_alive():
+            tl.after(100, poll)
+            return
+        tl.destroy()
+        if state['error'] is not None:
+            route_msg("Save Problem", state['error'], "error")
         else:
-            #if not RUN_CONSOLE:
-            display_results(final)
+            route_msg("Finished", outpath + "\n" + state['note'], "info")
 
-    # The Output; command can specify an output file for the results of the query
-    if outpath is None:
-        if RUN_CONSOLE is True:
-            print("no output path")
+    poll()
+
+
+def copy_result():
+    ''' Copy button - the displayed result as tab separated text (pastes into a spreadsheet) '''
+    load_modules()  # pressed before the first run pandas may still be unloaded
+    if not isinstance(DF, pd.DataFrame):
+        return
+    cap = int(cliprows_)  # ClipRows in sqlcel.ini - 0 copies every displayed row
+    df = DF if cap <= 0 else DF.head(cap)
+    root.clipboard_clear()
+    root.clipboard_append(df.to_csv(sep="\t", index=False))
+    note = "copied {:,} rows".format(len(df))
+    if len(df) < len(DF):
+        note += " of {:,} (ClipRows) - Save As writes them all".format(len(DF))
+    elif MORE is not None:
+        note += " - more rows are pending, Save As writes them all"
+    var_bottom.set(note)
+
+
+def show_pending():
+    ''' note on the bottom label that more rows can be fetched '''
+    if MORE is not None and not RUN_CONSOLE:
+        var_bottom.set(var_bottom.get() + "  (more rows - More / Full)")
+
+
+def fetch_more(full=False):
+    ''' "More" and "Full" buttons - add the next page (or all) pending rows to the display '''
+    global MORE
+    if MORE is None:
+        return
+    limit = int(rows_)
+    rows = MORE['rows'](None if full else limit)
+    if full or len(rows) < limit:
+        close_more()  # cursor is done
+    if len(rows) > 0:
+        display_results(pd.concat([DF, rows], ignore_index=True))
+    show_pending()
+
+
+#
+# Parallel aggregation - one GROUP BY query split by rowid ranges over threads
+#
+
+def parallel_frame(engine, sql_code, params):
+    '''
+    Run a single table aggregate query (SUM COUNT MIN MAX AVG TOTAL, optional
+    WHERE, GROUP BY, ORDER BY, LIMIT) on WORKERS connections at once, each over
+    one rowid range of the table, and merge the partial results in pandas.
+    sqlite3 releases the GIL while a query steps, so threads use every core.
+    returns None when the query can not be split this way - run it normally
+    '''
+    plan = parallel_plan(sql_code)
+    if plan is None:
+        return None
+    path = SCRATCH[engine]
+    conn = sqlite3.connect(path)
+    try:
+        lo, hi = conn.execute('SELECT min(rowid), max(rowid) FROM "%s"' % plan['table']).fetchone()
+        # column names exactly as sqlite gives them - LIMIT 0 does not run the query
+        names = [d[0] for d in conn.execute("SELECT * FROM ({}) LIMIT 0".format(sql_code), params).description]
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    if lo is None or hi - lo < PARALLEL_ROWS or len(names) != len(plan['items']):
+        return None
+
+    step = (hi - lo) // WORKERS + 1
+    ranges = [(start, min(start + step - 1, hi)) for start in range(lo, hi + 1, step)]
+    where = "({}) AND ".format(plan['where']) if plan['where'] else ""
+    partial = "SELECT {} FROM {} WHERE {}rowid BETWEEN :plo AND :phi{}".format(
+        ", ".join(plan['select']), plan['source'], where,
+        " GROUP BY " + ", ".join(plan['keys']) if plan['keys'] else "")
+    cols = ["k%d" % i for i in range(len(plan['keys']))] + ["p%d" % i for i in range(len(plan['parts']))]
+
+    def run(bounds):
+        wc = sqlite3.connect(path)
+        try:
+            tune_scratch(wc)
+            binds = dict(params or {}, plo=bounds[0], phi=bounds[1])
+            cur = wc.execute(partial, binds)
+            return pd.DataFrame.from_records(cur.fetchall(), columns=cols)
+        finally:
+            wc.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            parts = list(pool.map(run, ranges))
+        df = merge_parts(pd.concat(parts, ignore_index=True), plan, names)
+    except Exception as e:
+        logging.debug("parallel: {} - running the query on one connection".format(e))
+        return None
+    logging.debug("parallel: {} rowid ranges of {} on {} workers".format(len(ranges), plan['table'], WORKERS))
+    return df
+
+
+def parallel_plan(sql_code):
+    '''
+    Split a query into what every partition runs and how to merge it.
+    returns None for anything but one table aggregated by PARALLEL_AGGS
+    '''
+    sql = " ".join(sql_code.split())
+    if sql.lower().count("select") != 1 or re.search(r"\b(join|union|having|distinct|over|window)\b", sql, re.I) \
+            or re.search(r"'[^']*\b(where|group|order|limit)\b[^']*'", sql, re.I):
+        return None
+    m = re.fullmatch(r'select (?P<items>.+?) from (?P<source>"?(?P<table>\w+)"?(?: (?:as )?(?!(?:where|group|order|limit)\b)\w+)?)'
+                     r'(?: where (?P<where>.+?))?(?: group by (?P<group>.+?))?(?: order by (?P<order>.+?))?'
+                     r'(?: limit (?P<limit>\d+)(?: offset (?P<offset>\d+))?)?', sql.strip(), re.I)
+    if m is None:
+        return None
+    items = split_top(m.group('items'))
+    keys = split_top(m.group('group')) if m.group('group') else []
+    plan = {'table': m.group('table'), 'source': m.group('source'), 'where': m.group('where'),
+            'items': [], 'keys': [], 'select': [], 'parts': [],
+            'order': m.group('order'), 'limit': m.group('limit'), 'offset': m.group('offset')}
+    exprs = []  # expression of every item without its alias
+    for item in items:
+        a = re.fullmatch(r'(.*?[\w)"])(?: as)? "?([a-z_]\w*)"?', item, re.I)  # AS is optional
+        exprs.append((a.group(1) if a else item, a.group(2) if a else None))
+    for k in keys:  # GROUP BY 1 or an alias means the expression of that item
+        if k.isdigit() and 0 < int(k) <= len(exprs):
+            k = exprs[int(k) - 1][0]
+        else:
+            k = next((e for e, alias in exprs if alias is not None and alias.lower() == k.lower()), k)
+        plan['keys'].append(k)
+    norm = [re.sub(r'\s', '', k.lower()) for k in plan['keys']]
+    for expr, alias in exprs:
+        agg = re.fullmatch(r'(\w+) ?\((.*)\)', expr)
+        if re.sub(r'\s', '', expr.lower()) in norm:
+            plan['items'].append(('key', norm.index(re.sub(r'\s', '', expr.lower()))))
+        elif agg and agg.group(1).lower() in PARALLEL_AGGS and len(split_top(agg.group(2))) == 1 \
+                and balanced(agg.group(2)):
+            fn, arg = agg.group(1).lower(), agg.group(2)
+            if fn == 'avg':
+                plan['items'].append(('avg', len(plan['parts']), len(plan['parts']) + 1))
+                plan['parts'] += [('sum', "SUM(%s)" % arg), ('sum', "COUNT(%s)" % arg)]
+            else:
+                merge = 'sum' if fn in ('sum', 'count', 'total') else fn
+                plan['items'].append((merge, len(plan['parts'])))
+                plan['parts'].append((merge, "{}({})".format(fn.upper(), arg)))
+        else:
+            return None  # not grouped and not an aggregate that merges
+    if not any(i[0] != 'key' for i in plan['items']):
+        return None
+    plan['select'] = ["{} AS k{}".format(k, i) for i, k in enumerate(plan['keys'])] + \
+                     ["{} AS p{}".format(p, i) for i, (_, p) in enumerate(plan['parts'])]
+    plan['exprs'] = exprs
+    return plan
+
+
+def merge_parts(df, plan, names):
+    ''' combine the partial results of parallel_frame into the query result '''
+    keys = ["k%d" % i for i in range(len(plan['keys']))]
+    parts = {}
+    if keys:
+        grouped = df.groupby(keys, dropna=False, sort=False)
+        merged = grouped.size().reset_index()[keys]
+        for i, (fn, _) in enumerate(plan['parts']):
+            col = "p%d" % i
+            merged[col] = (grouped[col].sum(min_count=1) if fn == 'sum' else getattr(grouped[col], fn)()).values
     else:
-        if outpath.endswith("xlsx") or outpath.endswith("xls"):
-            final.to_excel(outpath, index=False)
-        elif outpath.lower().endswith("csv"):
-            final.to_csv(outpath, index=False)
-        else:  # assuming sqlite then
-            e = create_engine('sqlite:///' + outpath, echo=False)  # , encoding='utf-8'
-            conn = e.connect()
-            final.to_sql('table1', conn, if_exists='replace')
-            conn.close()
+        merged = pd.DataFrame({"p%d" % i: [df["p%d" % i].sum(min_count=1) if fn == 'sum' else getattr(df["p%d" % i], fn)()]
+                               for i, (fn, _) in enumerate(plan['parts'])})
+    for name, item in zip(names, plan['items']):
+        if item[0] == 'key':
+            parts[name] = merged["k%d" % item[1]]
+        elif item[0] == 'avg':
+            parts[name] = merged["p%d" % item[1]] / merged["p%d" % item[2]].where(merged["p%d" % item[2]] != 0)
+        else:
+            parts[name] = merged["p%d" % item[1]]
+    result = pd.DataFrame(parts)
+
+    # ORDER BY an output column (name, alias, position or item expression) - else the GROUP BY order
+    if plan['order']:
+        by, ascending = [], []
+        for term in split_top(plan['order']):
+            o = re.fullmatch(r'(.+?)(?: (asc|desc))?', term, re.I)
+            key = o.group(1)
+            exprs = [re.sub(r'\s', '', e.lower()) for e, _ in plan['exprs']]
+            if key.isdigit() and 0 < int(key) <= len(names):
+                by.append(names[int(key) - 1])
+            elif key.strip('"') in names:
+                by.append(key.strip('"'))
+            elif re.sub(r'\s', '', key.lower()) in exprs:
+                by.append(names[exprs.index(re.sub(r'\s', '', key.lower()))])
+            else:
+                raise ValueError("ORDER BY " + key + " is not an output column")
+            ascending.append((o.group(2) or "asc").lower() == "asc")
+        result = result.sort_values(by, ascending=ascending, na_position='first' if ascending[0] else 'last')
+    elif keys:
+        by = [n for n, item in zip(names, plan['items']) if item[0] == 'key']
+        if by:
+            result = result.sort_values(by, na_position='first')
+    start = int(plan['offset'] or 0)
+    if plan['limit'] is not None:
+        result = result.iloc[start:start + int(plan['limit'])]
+    return result.reset_index(drop=True)
+
+
+def split_top(text):
+    ''' split at the commas outside of parentheses and quotes '''
+    items, depth, quote, cur = [], 0, None, ""
+    for ch in text:
+        if quote:
+            quote = None if ch == quote else quote
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            items.append(cur.strip())
+            cur = ""
+            continue
+        cur += ch
+    items.append(cur.strip())
+    return items
 
-        route_msg("Finished", "Output file created", "info")
+
+def balanced(text):
+    ''' parentheses of an expression open and close in order '''
+    depth = 0
+    for ch in text:
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+#
+# Output writers
+#
+
+def write_xlsx(df, outpath, progress=None):
+    '''
+    Write the result to an xlsx file without building the workbook in memory:
+    xlsxwriter in constant_memory mode, openpyxl write-only if it is missing.
+    Rows past the Excel limit continue on Sheet2, Sheet3 ...
+    Date columns get one column format instead of a format per cell.
+    progress is called with the rows written so far (Save As)
+    returns a short note with the write speed
+    '''
+    t0 = time.perf_counter()
+    dates = [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])]
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+
+    if xlsxwriter is not None:
+        wb = xlsxwriter.Workbook(outpath, {'constant_memory': True,
+                                           'strings_to_urls': False})
+        bold = wb.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        datefmt = wb.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+
+        def new_sheet():
+            ws = wb.add_worksheet()
+            ws.write_row(0, 0, [str(c) for c in df.columns], bold)
+            for c in dates:
+                col = df.columns.get_loc(c)
+                ws.set_column(col, col, 19, datefmt)
+            return ws
+
+        def add_rows(ws, first, values):
+            for r, row in enumerate(values, first):
+                ws.write_row(r, 0, row)
+    else:
+        from openpyxl import Workbook
+        from openpyxl.styles import Font as XlFont
+        wb = Workbook(write_only=True)
+
+        def new_sheet():
+            ws = wb.create_sheet()
+            for c in dates:
+                ws.column_dimensions[excel_col(df.columns.get_loc(c))].number_format = 'yyyy-mm-dd hh:mm:ss'
+            ws.append([str(c) for c in df.columns])
+            return ws
+
+        def add_rows(ws, first, values):
+            for row in values:
+                ws.append(row)
+
+    for start in range(0, max(len(df), 1), XLSX_ROWS):
+        ws = new_sheet()
+        for part in range(start, min(start + XLSX_ROWS, len(df)), XLSX_CHUNK):
+            chunk = df.iloc[part:min(part + XLSX_CHUNK, start + XLSX_ROWS)]
+            add_rows(ws, part - start + 1, xlsx_values(chunk, dates, xlsxwriter is not None))
+            if progress is not None:
+                progress(part + len(chunk))
+
+    if xlsxwriter is not None:
+        wb.close()
+    else:
+        wb.save(outpath)
+    secs = time.perf_counter() - t0
+    note = "{:,} rows in {:.1f} s ({:,.0f} rows/s)".format(len(df), secs, len(df) / max(secs, 1e-6))
+    logging.debug("xlsx output: " + note)
+    return note
+
+
+def write_sqlite(df, outpath, table, mode, keys, progress=None):
+    '''
+    Write the result to a table of a sqlite file in one transaction (WAL journal).
+    mode None replaces the rows, 'append' adds them, 'upsert' inserts new rows
+    and updates the rows whose keys are already there.
+    An existing table keeps its indexes - a new one is created from the result columns.
+    '''
+    cols = [str(c) for c in df.columns]
+    names = ", ".join('"' + c + '"' for c in cols)
+    conn = sqlite3.connect(outpath, isolation_level=None)  # BEGIN ... COMMIT below, DDL included
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        have = [r[1] for r in conn.execute('PRAGMA table_info("%s")' % table)]
+        conn.execute("BEGIN")  # one transaction - commit at the end or nothing
+        try:
+            if have and have != cols and mode is None:
+                conn.execute('DROP TABLE "%s"' % table)  # different columns - start over
+                have = []
+            if not have:
+                types = ", ".join('"{}" {}'.format(c, sqlite_type(df[c])) for c in df.columns)
+                conn.execute('CREATE TABLE "{}" ({})'.format(table, types))
+            elif mode is None:
+                conn.execute('DELETE FROM "%s"' % table)
+            insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(table, names, ", ".join("?" * len(cols)))
+            if mode == 'upsert':
+                keylist = ", ".join('"' + k + '"' for k in keys)
+                # ON CONFLICT needs a unique index on the keys
+                conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS "ux_{}_{}" ON "{}" ({})'.format(
+                    table, "_".join(keys), table, keylist))
+                sets = ", ".join('"{0}" = excluded."{0}"'.format(c) for c in cols if c not in keys)
+                insert += " ON CONFLICT ({}) DO ".format(keylist) + ("UPDATE SET " + sets if sets else "NOTHING")
+            for start in range(0, len(df), SQLITE_CHUNK):
+                conn.executemany(insert, sqlite_rows(df.iloc[start:start + SQLITE_CHUNK]))
+                if progress is not None:
+                    progress(min(start + SQLITE_CHUNK, len(df)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")  # the old table and its rows stay as they were
+            raise
+    finally:
+        conn.close()
+
+
+def save_frame(df, outpath, progress):
+    '''
+    Save As writer - csv, xlsx, sqlite (table1) or parquet by the file extension.
+    Runs in a background thread: no Tk calls, progress gets the rows written.
+    returns a short note with the write speed
+    '''
+    t0 = time.perf_counter()
+    ext = os.path.splitext(outpath.lower())[1]
+    if ext in ('.xlsx', '.xls'):
+        return write_xlsx(df, outpath, progress)
+    if ext in ('.sqlite', '.sqlite3', '.db'):
+        write_sqlite(df, outpath, 'table1', None, [], progress)
+    elif ext == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.Schema.from_pandas(df, preserve_index=False)  # whole columns - same types in every chunk
+        with pq.ParquetWriter(outpath, schema) as writer:
+            for start in range(0, len(df), SAVE_CHUNK):
+                chunk = df.iloc[start:start + SAVE_CHUNK]
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                progress(start + len(chunk))
+    else:
+        with open(outpath, 'w', newline='', encoding='utf-8') as fh:
+            for start in range(0, max(len(df), 1), SAVE_CHUNK):
+                chunk = df.iloc[start:start + SAVE_CHUNK]
+                chunk.to_csv(fh, index=False, header=start == 0)
+                progress(start + len(chunk))
+    secs = time.perf_counter() - t0
+    return "{:,} rows in {:.1f} s ({:,.0f} rows/s)".format(len(df), secs, len(df) / max(secs, 1e-6))
+
+
+def sqlite_type(col):
+    ''' sqlite column type for a DataFrame column - same names pandas to_sql uses '''
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_integer_dtype(col):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(col):
+        return "REAL"
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return "TIMESTAMP"
+    return "TEXT"
+
+
+def sqlite_rows(chunk):
+    ''' rows of a chunk as python values sqlite3 can bind - missing values become NULL '''
+    values = []
+    for c in chunk.columns:
+        col = chunk[c]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            col = col.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+        values.append(col.astype(object).where(col.notna(), None).tolist())
+    return zip(*values)
+
+
+def xlsx_values(chunk, dates, serial):
+    '''
+    Rows of a chunk as lists ready for the xlsx writer - missing values become None,
+    +-inf the text inf / -inf like pandas' to_excel (inf_rep).
+    serial=True turns dates into Excel day numbers in one vectorized step
+    (xlsxwriter then only writes numbers and the column format shows the date).
+    '''
+    chunk = chunk.copy()
+    for c in dates:
+        col = chunk[c]
+        if col.dt.tz is not None:
+            col = col.dt.tz_localize(None)
+        if serial:
+            chunk[c] = (col - EXCEL_EPOCH) / pd.Timedelta(days=1)
+        else:
+            chunk[c] = col.astype(object)
+    chunk = chunk.astype(object)
+    for c in chunk.columns[(chunk == np.inf).any() | (chunk == -np.inf).any()]:
+        chunk[c] = chunk[c].replace({np.inf: 'inf', -np.inf: '-inf'})
+    return chunk.where(chunk.notna(), None).values.tolist()
+
+
+def excel_col(n):
+    ''' zero based column number to Excel letters: 0 -> A, 27 -> AB '''
+    name = ""
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        name = chr(65 + r) + name
+    return name
+
+
+#
+# Parameter tables - one code file run for many Params values
+#
+
+def run_params(sql, table):
+    '''
+    --params table.csv: run the code file once for every row of a csv whose
+    header names Params. The Inputs are loaded once into one engine and, as the
+    sql text stays the same, sqlite3 reuses its prepared statements.
+    Output paths are templates: reports/{center}.csv
+    '''
+    spec = parse_code(sql)
+    if spec['error'] is not None:
+        print("SQL File - " + spec['error'])
+        return
+    engine = work_engine(spec)
+    loaded = {}
+    with open(table, newline='', encoding='utf-8') as fh:
+        rows = list(csv.DictReader(fh))
+    failed = 0
+    t0 = time.perf_counter()
+    for row in rows:
+        params = {k.strip(): param_value(v) for k, v in row.items() if k}
+        label = ", ".join("{}={}".format(k, v) for k, v in params.items())
+        LAST_MSG.text = "Problem running the code file"
+        final = exec_sql(sql, engine, loaded, show=False, params=params)
+        if final is None:
+            failed += 1
+            print("{}: failed - {}".format(label, LAST_MSG.text))
+        else:
+            print("{}: {} rows".format(label, len(final)))
+    print("{} runs, {} failed, {:.2f} s".format(len(rows), failed, time.perf_counter() - t0))
+
+
+#
+# Explain - query plans of the sql blocks and index / rewrite advice
+#
+
+PLAN_FLAGS = ((r"^SCAN (?:TABLE )?\S+$|^SCAN (?:TABLE )?\S+ AS \S+$", "full scan - reads every row"),
+              (r"USE TEMP B-TREE FOR (GROUP BY|ORDER BY|DISTINCT)", "sorts all rows for this"),
+              (r"AUTOMATIC (?:COVERING |PARTIAL )?INDEX", "builds a throw away index for this query"),
+              (r"CORRELATED", "runs once for every outer row"))
+NOT_ALIAS = {'where', 'on', 'join', 'left', 'right', 'inner', 'outer', 'full', 'cross',
+             'natural', 'group', 'order', 'limit', 'using', 'union', 'having', 'window'}
+
+
+def explain_sql(sql, timing=False):
+    '''
+    Load the Inputs like exec_sql and report the EXPLAIN QUERY PLAN of every
+    sql block with its slow steps flagged, suggested Index lines and rewrites.
+    timing=True also runs each block without and with the suggested indexes.
+    returns the report as (text, tag) lines - tag is None, 'head', 'slow' or 'hint'
+    '''
+    spec = parse_code(sql)
+    if spec['error'] is not None:
+        route_msg("SQL File", spec['error'], "error")
+        return
+    TIMES.steps = {}
+    engine = work_engine(spec, drop=False)  # its own engine - the displayed result keeps its one
+    if not load_inputs(engine, spec, {}) or not make_indexes(engine, spec, spec['tbl']):
+        drop_engine(engine)
+        return
+    conn = engine.raw_connection()
+    report = []
+    try:
+        for n, query in enumerate(spec['queries'], 1):
+            sql_code = query['sql_code']
+            report.append(("sql block {}{}".format(n, " " + query['name'] if query['name'] else ""), 'head'))
+            plan = plan_rows(conn, sql_code, spec['params'])
+            for depth, detail in plan:
+                note = plan_flag(detail)
+                report.append(("  " * (depth + 1) + detail + ("    <- " + note if note else ""),
+                               'slow' if note else None))
+            indexes, hints = advise(conn, sql_code, plan)
+            if indexes:
+                report.append(("  suggested - add to the code file:", 'hint'))
+                report.append(("    Index", 'hint'))
+                for table, cols in indexes:
+                    report.append(("    {} {}".format(table, ",".join(cols)), 'hint'))
+            for h in hints:
+                report.append(("  " + h, 'hint'))
+            if not indexes and not hints:
+                report.append(("  nothing to suggest", None))
+            if timing and indexes:
+                report += index_timing(conn, sql_code, indexes, spec['params'])
+            if query['name'] is not None:
+                # later blocks read this table - timing needs its rows, the plan only its columns
+                cur = conn.cursor()
+                cur.execute('DROP TABLE IF EXISTS "%s"' % query['name'])
+                cur.execute('CREATE TABLE "{}" AS SELECT * FROM ({}){}'.format(
+                    query['name'], sql_code, "" if timing else " LIMIT 0"), spec['params'])
+                conn.commit()
+                make_indexes(engine, spec, [query['name']])
+            report.append(("", None))
+    except Exception as e:
+        route_msg("SQL Syntax Error", e, "error")
+        return
+    finally:
+        conn.close()
+        drop_engine(engine)
+    return report
+
+
+def plan_rows(conn, sql_code, params):
+    ''' EXPLAIN QUERY PLAN of a statement as (depth, detail) rows '''
+    cur = conn.cursor()
+    cur.execute("EXPLAIN QUERY PLAN " + sql_code, params)
+    depth = {0: -1}
+    rows = []
+    for node, parent, _, detail in cur.fetchall():
+        depth[node] = depth.get(parent, -1) + 1
+        rows.append((depth[node], detail))
+    return rows
+
+
+def plan_flag(detail):
+    ''' why a query plan step is slow - None when it is not '''
+    for pattern, note in PLAN_FLAGS:
+        if re.search(pattern, detail):
+            return note
+    return None
+
+
+def advise(conn, sql_code, plan):
+    '''
+    Index suggestions for the scanned tables of a plan: columns compared with =
+    or IN first, then range columns, or the GROUP BY / ORDER BY columns when
+    the plan sorts. Also rewrite hints for patterns no index can help.
+    returns [(table, [columns])] and [hint text]
+    '''
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {r[0] for r in cur.fetchall()}
+    aliases = {t: t for t in tables}
+    for m in re.finditer(r'\b(?:from|join)\s+"?(\w+)"?(?:\s+(?:as\s+)?(\w+))?', sql_code, re.I):
+        if m.group(1) in tables and m.group(2) and m.group(2).lower() not in NOT_ALIAS:
+            aliases[m.group(2)] = m.group(1)
+
+    preds = " ".join(re.findall(r'\b(?:where|on|having)\b(.*?)(?=\b(?:group\s+by|order\s+by|limit|join|'
+                                r'left|inner|cross|union|window)\b|$)', sql_code, re.I | re.S))
+    sorts = " ".join(d for _, d in plan if "TEMP B-TREE" in d)
+    indexes = []
+    for _, detail in plan:
+        m = re.match(r'SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$', detail)
+        if m is None or m.group(1) not in aliases:
+            continue
+        table = aliases[m.group(1)]
+        names = {table, m.group(2) or m.group(1)}
+        cur.execute('PRAGMA table_info("%s")' % table)
+        columns = [r[1] for r in cur.fetchall()]
+        eq, rng = [], []
+        for col in columns:
+            ref = r'(?:\b(\w+)\.)?"?\b%s\b"?' % re.escape(col)
+            for r in re.finditer(r'%s\s*(=|==|\bin\b|\bis\b|<|>|\bbetween\b)|(=|<|>)\s*%s' % (ref, ref),
+                                 preds, re.I):
+                qual = r.group(1) if r.group(2) else r.group(4)
+                if qual is not None and qual not in names:
+                    continue
+                op = (r.group(2) or r.group(5)).lower()
+                if op in ('=', '==', 'in', 'is') and col not in eq:
+                    eq.append(col)
+                elif op not in ('=', '==', 'in', 'is') and col not in rng:
+                    rng.append(col)
+        cols = eq + [c for c in rng if c not in eq][:1]  # one range column can use the index
+        for clause in ('GROUP BY', 'ORDER BY'):
+            if clause in sorts and not rng:
+                keys = clause_columns(sql_code, clause, names, columns)
+                if keys:
+                    cols = eq + [k for k in keys if k not in eq]
+                    break
+        if cols and (table, cols[:4]) not in indexes:
+            indexes.append((table, cols[:4]))
+    return indexes, rewrite_hints(sql_code, plan)
+
+
+def clause_columns(sql_code, clause, names, columns):
+    ''' columns of one table that make up a whole GROUP BY or ORDER BY clause - [] otherwise '''
+    m = re.search(r'\b%s\b(.*?)(?=\b(?:having|order\s+by|limit|window|union)\b|$)' % clause.replace(" ", r"\s+"),
+                  sql_code, re.I | re.S)
+    if m is None:
+        return []
+    keys = []
+    for item in m.group(1).split(","):
+        item = re.sub(r'\s+(asc|desc)\s*$', '', item.strip(), flags=re.I).strip('"')
+        qual, _, col = item.rpartition(".")
+        if col not in columns or (qual and qual.strip('"') not in names):
+            return []
+        keys.append(col)
+    return keys
+
+
+def rewrite_hints(sql_code, plan):
+    ''' patterns in a query that keep SQLite from using an index '''
+    hints = []
+    if re.search(r"\blike\s+'%", sql_code, re.I):
+        hints.append("LIKE '%...' with a leading % can not use an index")
+    if re.search(r'\bwhere\b.*\b(lower|upper|substr|trim|date|strftime|cast|ifnull|coalesce)\s*\(\s*[\w."]+',
+                 sql_code, re.I | re.S):
+        hints.append("a function around a column in WHERE hides it from indexes - compare the plain column")
+    if re.search(r'\bnot\s+in\s*\(\s*select\b', sql_code, re.I):
+        hints.append("NOT IN (SELECT ...) - NOT EXISTS or a LEFT JOIN ... IS NULL is usually faster")
+    if any("CORRELATED" in d for _, d in plan):
+        hints.append("correlated subquery - a JOIN to a GROUP BY subquery runs it once instead of per row")
+    if re.search(r'\bwhere\b.*\bor\b', sql_code, re.I | re.S) and any(plan_flag(d) and d.startswith("SCAN") for _, d in plan):
+        hints.append("OR over different columns scans the table - UNION ALL of indexed parts can avoid it")
+    return hints
+
+
+def index_timing(conn, sql_code, indexes, params):
+    ''' run a query without and with the suggested indexes - the indexes are dropped again '''
+    cur = conn.cursor()
+    t0 = time.perf_counter()
+    cur.execute(sql_code, params).fetchall()
+    before = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for table, cols in indexes:
+        cur.execute(index_ddl(table, cols))
+    build = time.perf_counter() - t0
+    plan = plan_rows(conn, sql_code, params)
+    t0 = time.perf_counter()
+    cur.execute(sql_code, params).fetchall()
+    after = time.perf_counter() - t0
+    for table, cols in indexes:
+        cur.execute('DROP INDEX IF EXISTS "ix_{}_{}"'.format(table, "_".join(cols)))
+    lines = [("  timing", 'head'),
+             ("    without indexes  {:.3f} s".format(before), None),
+             ("    with indexes     {:.3f} s  (+ {:.3f} s to build them)".format(after, build), None)]
+    for depth, detail in plan:
+        lines.append(("    " + "  " * depth + detail, 'slow' if plan_flag(detail) else None))
+    if after + build < before:
+        lines.append(("    the indexes pay off - Inputs are reloaded and indexed every run", 'hint'))
+    elif after < before:
+        lines.append(("    faster only when the tables stay loaded (watch or serve mode)", 'hint'))
+    else:
+        lines.append(("    the indexes do not help this query", 'hint'))
+    return lines
+
+
+def explain_view():
+    ''' Explain button - popup the plan report of the code in the code window '''
+    load_modules()
+    sql = code.get("1.0", END)
+    frm_out.config(text=" P r o c e s s i n g . . . ")
+    frm_out.update()
+    report = explain_sql(sql)
+    frm_out.config(text="     SQL Output ")
+    if report is None:
+        return
+    tl = Toplevel()
+    tl.wm_title("Explain - query plans")
+    view = Text(tl, wrap=NONE, width=110, height=30, font=Font(family=ofont_, size=10))
+    view.tag_configure('head', font=Font(family=ofont_, size=10, weight='bold'))
+    view.tag_configure('slow', foreground='red')
+    view.tag_configure('hint', foreground='darkgreen')
+    view.pack(side="top", fill="both", expand=True, padx=5, pady=5)
+
+    def show(lines):
+        view.delete("1.0", END)
+        for text, tag in lines:
+            view.insert(END, text + "\n", tag or ())
+
+    def time_it():
+        tl.config(cursor="watch")
+        tl.update()
+        lines = explain_sql(sql, timing=True)
+        tl.config(cursor="")
+        if lines is not None:
+            show(lines)
+
+    show(report)
+    Button(tl, text='Time indexes', width=14, command=time_it).pack(side="bottom", pady=5)
+
+
+#
+# Watch mode - re-run the code file when it or its inputs change
+#
+
+def watch_stamps(sql):
+    ''' stamps of the code file and every Input path it names '''
+    paths = [SQL_file] + parse_code(sql)['infile']
+    return {f: file_stamp(f) for f in paths}
+
+
+def watch_console():
+    '''
+    --watch: poll the code file and its Input files and re-run when one changed.
+    A change must hold still for one poll before the run so half written files
+    are not read. Only the changed inputs are reloaded (see load_inputs).
+    '''
+    global WATCHING
+    WATCHING = True
+    engine = create_engine('sqlite://', echo=False)
+    loaded = {}
+    last = None  # stamps of the last run
+    seen = None  # stamps of the previous poll
+    try:
+        while True:
+            try:
+                with open(SQL_file) as fh:
+                    sql = fh.read()
+                now = watch_stamps(sql)
+            except OSError as e:
+                # editors that save by rename remove the code file for a moment
+                logging.debug("watch: {} - polling again".format(e))
+                time.sleep(WATCH_POLL)
+                continue
+            if now == seen and now != last:
+                logging.debug("watch: change detected - running " + SQL_file)
+                try:
+                    exec_sql(sql, engine, loaded)
+                except Exception as e:
+                    logging.debug("watch: run failed - {} - reloading on the next change".format(e))
+                    loaded.clear()
+                last = now
+            seen = now
+            time.sleep(WATCH_POLL)
+    except KeyboardInterrupt:
+        logging.debug("watch: stopped")
+
+
+def toggle_watch():
+    ''' Watch checkbox - start or stop watching the saved code file '''
+    global WATCHING, WATCH_STATE
+    if var_watch.get() == 0:
+        WATCHING = False
+        return
+    if len(SQL_file) < 2:
+        var_watch.set(0)
+        route_msg("Watch", "Save the code file first", "warning")
+        return
+    WATCHING = True
+    load_modules()
+    WATCH_STATE = {'engine': create_engine('sqlite://', echo=False),
+                   'loaded': {}, 'last': None, 'seen': None}
+    root.after(10, watch_gui)
+
+
+def watch_gui():
+    ''' GUI side of watch mode - one poll, then schedules the next '''
+    if not WATCHING:
+        return
+    try:
+        with open(SQL_file) as fh:
+            sql = fh.read()
+        now = watch_stamps(sql)
+    except OSError:
+        sql = None
+    if sql is not None:
+        if now == WATCH_STATE['seen'] and now != WATCH_STATE['last']:
+            if not code.edit_modified() and code.get("1.0", "end-1c") != sql:
+                code.delete("1.0", END)  # code file was changed outside sqlcel
+                code.insert(END, sql)
+                code.edit_modified(False)
+            frm_out.config(text=" P r o c e s s i n g . . . ")
+            frm_out.update()
+            try:
+                exec_sql(sql, WATCH_STATE['engine'], WATCH_STATE['loaded'], limit=int(rows_))
+            except Exception as e:
+                logging.debug("watch: run failed - {} - reloading on the next change".format(e))
+                WATCH_STATE['loaded'].clear()
+                var_bottom.set("Watch: run failed - " + str(e))
+            frm_out.config(text="     SQL Output ")
+            WATCH_STATE['last'] = now
+        WATCH_STATE['seen'] = now
+    root.after(int(WATCH_POLL * 1000), watch_gui)
+
+
+#
+# Serve mode - long running local query service
+#
+
+class PoolMixIn:
+    ''' hands each accepted request to a fixed size pool of worker threads '''
+    workers = 4
+
+    def process_request(self, request, client_address):
+        if getattr(self, 'pool', None) is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class PoolHTTPServer(PoolMixIn, HTTPServer):
+    ''' local TCP port '''
+
+
+class PoolUnixServer(PoolMixIn, socketserver.UnixStreamServer):
+    ''' Unix domain socket '''
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Runs a code file through exec_sql and streams the result back.
+      GET  /run?file=job.txt&format=csv      code file on the server
+      POST /run?format=json                  code file text is the request body
+    format is csv (default), json or arrow (Arrow IPC stream)
+    any other query string value is a Params value: /run?file=job.txt&center=4100
+    '''
+
+    def do_GET(self):
+        self.run_code()
+
+    def do_POST(self):
+        self.run_code()
+
+    def run_code(self):
+        t0 = time.perf_counter()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        fmt = query.get('format', ['csv'])[0].lower()
+        if url.path != "/run" or fmt not in SERVE_FORMATS:
+            self.send_error(404, "use /run?format=csv|json|arrow")
+            return
+        try:
+            if 'file' in query:
+                with open(query['file'][0]) as fh:
+                    sql = fh.read()
+            else:
+                size = int(self.headers.get('Content-Length', 0))
+                sql = self.rfile.read(size).decode('utf-8')
+        except (OSError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+
+        # each worker thread keeps its own engine so inputs stay loaded (warm)
+        if getattr(SERVE_STATE, 'engine', None) is None:
+            SERVE_STATE.engine = create_engine('sqlite://', echo=False)
+            SERVE_STATE.loaded = {}
+        LAST_MSG.text = "Problem running the code file"
+        params = {k: param_value(v[0]) for k, v in query.items() if k not in ('file', 'format')}
+        final = exec_sql(sql, SERVE_STATE.engine, SERVE_STATE.loaded, show=False, params=params)
+        if final is None:
+            self.send_error(400, LAST_MSG.text.replace("\n", " "))
+            return
+
+        steps = dict(TIMES.steps)
+        steps['total'] = time.perf_counter() - t0
+        self.send_response(200)
+        self.send_header('Content-Type', SERVE_FORMATS[fmt])
+        self.send_header('X-Sqlcel-Rows', str(len(final)))
+        self.send_header('Server-Timing', ", ".join(
+            "{};dur={:.1f}".format(k, v * 1000) for k, v in steps.items()))
+        self.end_headers()
+        self.send_result(final, fmt)
+
+    def send_result(self, final, fmt):
+        ''' stream the result in chunks so big results are not built as one string '''
+        if fmt == 'arrow':
+            import pyarrow as pa
+            table = pa.Table.from_pandas(final, preserve_index=False)
+            with pa.ipc.new_stream(self.wfile, table.schema) as writer:
+                writer.write_table(table, max_chunksize=SERVE_CHUNK)
+            return
+        if fmt == 'json':
+            self.wfile.write(b"[")
+        for start in range(0, max(len(final), 1), SERVE_CHUNK):
+            part = final.iloc[start:start + SERVE_CHUNK]
+            if fmt == 'csv':
+                self.wfile.write(part.to_csv(index=False, header=start == 0).encode('utf-8'))
+            elif len(part):
+                if start > 0:
+                    self.wfile.write(b",")
+                self.wfile.write(part.to_json(orient='records', date_format='iso')[1:-1].encode('utf-8'))
+        if fmt == 'json':
+            self.wfile.write(b"]")
+
+    def log_message(self, format, *args):
+        logging.debug("serve: " + format % args)
+
+
+def serve(address, workers):
+    '''
+    --serve PORT|SOCKET: answer code file requests until interrupted.
+    A number listens on 127.0.0.1:PORT, anything else is a Unix socket path.
+    '''
+    PoolMixIn.workers = workers
+    if address.isnumeric():
+        server = PoolHTTPServer(('127.0.0.1', int(address)), QueryHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)  # stale socket from an earlier run
+        server = PoolUnixServer(address, QueryHandler)
+    logging.debug("serve: listening on {} with {} workers".format(address, workers))
+    print("sqlcel serving on", address, "(Ctrl-c to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.debug("serve: stopped")
+    finally:
+        server.server_close()
 
 
 def route_msg(title, text, typ):
     ''' directs GUI and CONSOLE runtime route_msg '''
     if RUN_CONSOLE:
         logging.debug(title + " - " + str(text))
+        LAST_MSG.text = title + " - " + str(text)  # serve mode reports this to the client
         return
 
     frm_out.config(text="     SQL Output ")
@@ -680,7 +2878,7 @@ def pop2func(n):
 def highlite():
     ''' highlight code '''
     global t
-    highlight_pattern(r'^[Ss][Qq][Ll]|^[Ii][Nn][Pp][Uu][Tt]|^[Oo][Uu][Tt][Pp][Uu][Tt]|^[Dd][Aa][Tt][Ee][Cc][Oo][Ll][Ss].*\n',
+    highlight_pattern(r'^[Ss][Qq][Ll]|^[Ii][Nn][Pp][Uu][Tt]|^[Oo][Uu][Tt][Pp][Uu][Tt]|^[Ii][Nn][Dd][Ee][Xx]$|^[Pp][Aa][Rr][Aa][Mm][Ss]$|^[Dd][Aa][Tt][Ee][Cc][Oo][Ll][Ss].*\n',
                       "sections", regexp=True)
     #highlight_pattern(r'^[IiSsOoDd].*\n', "sections", regexp=True)
     highlight_pattern(r"(\d+|\d\.\d|\.\d)", "numbers", regexp=True)
@@ -737,18 +2935,64 @@ def edit_ini():
     # os.system("python3 edito.py sqlcel.ini")
     subprocess.call([PYTHON, "edito.py", "sqlcel.ini"])
 
+def first_paint():
+    '''
+    Runs once the window is on screen: report the cold start time,
+    then set the icon and warm the heavy modules in the background
+    '''
+    global img
+    ready = time.perf_counter() - START_TIME
+    var_bottom.set("ready in {:.2f} s".format(ready))
+    logging.debug("first paint {:.2f} s".format(ready))
+    threading.Thread(target=warm_modules, daemon=True).start()
+    from PIL import Image, ImageTk
+    img = ImageTk.PhotoImage(Image.open("sqlcel.ico"))
+    root.iconphoto(False, img)
+
 #
 #    Check if console execution requested
 #       arg 1 is the SQL code file name
+#       --watch  keep running and re-run when the code or input files change
+#       --timings file.json  write the step timings of the run (bench_sqlcel.py)
+#       --explain [--index-timing]  print the query plans and index advice instead
+#       --params table.csv  run once per row of the table with its Params values
+#       --parallel N  split big GROUP BY queries over N worker connections
+#    or --serve PORT|SOCKET [--workers N] to run as a local query service
 #
 if len(sys.argv) > 1:
-    SQL_file = sys.argv[1]
+    args = sys.argv[1:]
+    SQL_file = args[0]
     RUN_CONSOLE = True
     logging.basicConfig(filename='log_sqlcel.txt', level=logging.NOTSET,
                         format='%(asctime)s - %(levelname)s - %(message)s')
     logging.debug("sqlcel.py - console run started: " + SQL_file)
-
-    processCodeFile()
+    load_modules()
+    if "--parallel" in args:
+        WORKERS = int(args[args.index("--parallel") + 1])
+        PARALLEL_SET = True
+
+    if args[0] == "--serve" and len(args) > 1:
+        workers = 4
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+        serve(args[1], workers)
+    elif "--watch" in args:
+        watch_console()
+    elif "--params" in args:
+        with open(SQL_file) as fh:
+            run_params(fh.read(), args[args.index("--params") + 1])
+    elif "--explain" in args:
+        with open(SQL_file) as fh:
+            report = explain_sql(fh.read(), timing="--index-timing" in args)
+        if report is None:
+            print(LAST_MSG.text)
+        else:
+            print("\n".join(text for text, tag in report))
+    else:
+        processCodeFile()
+        if "--timings" in args:
+            with open(args[args.index("--timings") + 1], "w") as fh:
+                json.dump(getattr(TIMES, 'steps', {}), fh, indent=1)
 
     sys.exit()
 
@@ -779,6 +3023,11 @@ btn_exec = Button(frm_sql, text='Add Input', command=add_df_src)
 btn_exec.grid(row=4, column=1, pady=5, padx=5, sticky='w')
 btn_quit = Button(frm_sql, text='Quit', command=quit_sql)
 btn_quit.grid(row=5, column=1, pady=5, padx=5, sticky='w')
+var_watch = IntVar()
+chk_watch = Checkbutton(frm_sql, text='Watch', variable=var_watch, command=toggle_watch)
+chk_watch.grid(row=6, column=1, pady=5, padx=5, sticky='w')
+btn_explain = Button(frm_sql, text='Explain', command=explain_view)
+btn_explain.grid(row=7, column=1, pady=5, padx=5, sticky='w')
 
 code = Text(frm_sql, bg=bg_, fg=fg_, padx=5)
 code.grid(row=1, column=2, rowspan=5, sticky='nsew', padx=5, pady=5)
@@ -880,12 +3129,24 @@ btn_info.grid(row=1, column=3, pady=7, padx=5)
 btn_graph = Button(frm_bottom, text='Plot XY', command=launch_plotter)
 btn_graph.grid(row=1, column=4, pady=7, padx=5)
 
+btn_more = Button(frm_bottom, text='More', command=fetch_more)
+btn_more.grid(row=1, column=5, pady=7, padx=5)
+
+btn_full = Button(frm_bottom, text='Full', command=lambda: fetch_more(True))
+btn_full.grid(row=1, column=6, pady=7, padx=5)
+
+btn_save_as = Button(frm_bottom, text='Save As', command=save_result)
+btn_save_as.grid(row=1, column=7, pady=7, padx=5)
+
+btn_copy = Button(frm_bottom, text='Copy', command=copy_result)
+btn_copy.grid(row=1, column=8, pady=7, padx=5)
+
 slider = Scale(frm_bottom, from_=6, to=18,
                value=11,
                orient=HORIZONTAL,
                length=100,
                command=alter_output_size)
-slider.grid(row=1, column=5, padx=5, pady=7)
+slider.grid(row=1, column=9, padx=5, pady=7)
 
 
 #Popups - code Text widget and df (disp) Text widget
@@ -947,8 +3208,6 @@ root.protocol("WM_DELETE_WINDOW", quit_sql)
 
 highlite()  # start the syntax colorization timer loop
 
-img = Image.open("sqlcel.ico")
-img = ImageTk.PhotoImage(img)
-root.iconphoto(False, img)
+root.after_idle(first_paint)
 
 root.mainloop()
@@ -0,0 +1,105 @@
+'''
+code file: test_sqlcel.py
+comments:
+    Regression tests for sqlcel.py
+    sqlcel.py starts the console run or the GUI when it is imported, so
+    the functions are loaded from the source up to that point instead.
+use:
+    python3 -m pytest -q test_sqlcel.py
+'''
+import os
+import sqlite3
+import types
+import pytest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+SQLCEL = os.path.join(HERE, "sqlcel.py")
+
+
+@pytest.fixture(scope="module")
+def sq():
+    ''' sqlcel.py without its console / GUI start up, as a console run '''
+    with open(SQLCEL) as fh:
+        src = fh.read()
+    cut = src.index("#\n#    Check if console")
+    mod = types.ModuleType("sqlcel")
+    mod.__file__ = SQLCEL
+    cwd = os.getcwd()
+    os.chdir(HERE)  # sqlcel.ini is read from the current directory
+    try:
+        exec(compile(src[:cut], SQLCEL, "exec"), mod.__dict__)
+    finally:
+        os.chdir(cwd)
+    mod.RUN_CONSOLE = True
+    mod.load_modules()
+    return mod
+
+
+def test_write_sqlite_failed_replace_keeps_old_table(sq, tmp_path):
+    outpath = str(tmp_path / "out.sqlite")
+    with sqlite3.connect(outpath) as conn:
+        conn.execute('CREATE TABLE "h" ("id" INTEGER, "v" TEXT)')
+        conn.executemany('INSERT INTO "h" VALUES (?, ?)', [(1, "a"), (2, "b")])
+    # new columns - the table is dropped and created again, then the insert fails
+    df = sq.pd.DataFrame({'id': [1, 2], 'w': [{'not': 'bindable'}, "x"]})
+    with pytest.raises(Exception):
+        sq.write_sqlite(df, outpath, "h", None, None)
+    with sqlite3.connect(outpath) as conn:
+        assert [r[1] for r in conn.execute('PRAGMA table_info("h")')] == ["id", "v"]
+        assert conn.execute('SELECT * FROM "h" ORDER BY id').fetchall() == [(1, "a"), (2, "b")]
+
+
+def test_params_output_problem_names_unnamed_block(sq, tmp_path):
+    (tmp_path / "s.csv").write_text("region,amount\na,1\nb,2\n")
+    code = ("Input\n{0}/s.csv\n0\ns\n\n"
+            "Params\nregion = 'a'\n\n"
+            "sql\nselect * from s\n\n"
+            "sql\nselect * from s where region = :region\n\n"
+            "Output\n{0}/missing/out_{{region}}.csv\n").format(tmp_path)
+    final = sq.exec_sql(code, show=False)
+    assert len(final) == 1
+    assert sq.LAST_MSG.text.startswith("Output Problem (sql block 2)")
+
+
+def sales_codes(tmp_path):
+    ''' code A counts the rows of the sales Input, code B makes a sales table of its own '''
+    (tmp_path / "sales.csv").write_text("region,amount\na,1\nb,2\nc,3\n")
+    code_a = "Input\n{}/sales.csv\n0\nsales\n\nsql\nselect count(*) n from sales\n".format(tmp_path)
+    code_b = "sql sales\nselect 1 as n\n\nsql\nselect * from sales\n"
+    return code_a, code_b
+
+
+def test_named_block_reloads_input_table_of_same_name(sq, tmp_path):
+    code_a, code_b = sales_codes(tmp_path)
+    engine, loaded = sq.create_engine('sqlite://'), {}
+    assert sq.exec_sql(code_a, engine, loaded, show=False)['n'][0] == 3
+    sq.exec_sql(code_b, engine, loaded, show=False)
+    assert sq.exec_sql(code_a, engine, loaded, show=False)['n'][0] == 3
+
+
+def test_serve_named_block_does_not_change_other_requests(sq, tmp_path):
+    import threading
+    import urllib.request
+    code_a, code_b = sales_codes(tmp_path)
+    sq.PoolMixIn.workers = 1  # one worker thread - every request gets the same warm engine
+    server = sq.PoolHTTPServer(('127.0.0.1', 0), sq.QueryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/run?format=csv" % server.server_address[1]
+
+    def post(code):
+        with urllib.request.urlopen(url, data=code.encode('utf-8')) as resp:
+            return resp.read().decode('utf-8').split()
+
+    try:
+        assert post(code_a) == ["n", "3"]
+        assert post(code_b) == ["n", "1"]
+        assert post(code_a) == ["n", "3"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_parallel_plan_single_letter_column_alias(sq):
+    plan = sq.parallel_plan("select g as grp, sum(v) total from t group by grp")
+    assert plan['exprs'] == [("g", "grp"), ("sum(v)", "total")]
+    assert plan['select'] == ["g AS k0", "SUM(v) AS p0"]